@@ -1,13 +1,23 @@
 import settings
 import hashlib
-import xmltodict
+import hmac
+import wechat_codec
 import shutil
-import wechat
-
-from fastapi import FastAPI, Body, Request, Response, HTTPException, BackgroundTasks, Depends
+import http_client
+import pipeline
+import tts_jobs
+import token_manager
+import db
+import cpu_pool
+import voice_ingest
+import metrics
+import time
+
+from datetime import datetime
+from fastapi import FastAPI, Body, Header, Request, Response, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
-from db import cache
 from english_assistant import EnglishBot
 
 app = FastAPI()
@@ -21,18 +31,75 @@ app.add_middleware(
 )
 
 
-if settings.ENV == 'dev' and not cache.get(wechat.TOKEN_CACHE_KEY):
-    access_token = wechat._refresh_token()
-
-# in prod we rely on a central server to periodically refresh the token
+@app.on_event('startup')
+async def start_pipeline():
+    tts_jobs.check_settings()
+    await run_in_threadpool(db.init_db)
+    metrics.register_collectors()
+    pipeline.start()
+
+@app.on_event('shutdown')
+async def stop_pipeline():
+    await pipeline.stop()
+    await run_in_threadpool(db.message_writer.close)
+    http_client.close()
+    await http_client.aclose()
+    cpu_pool.shutdown()
+    await db.async_engine.dispose()
+
+# in prod we rely on a central server to periodically refresh the token,
+# in dev token_manager fetches it from WeChat when needed
 @app.post('/token')
 def update_wechat_token(data: dict = Body(...)):
     access_token = data.get('access_token')
     print('access token received', access_token)
-    cache.set(wechat.TOKEN_CACHE_KEY, access_token, 7200)
+    token_manager.tokens.set(access_token, data.get('expires_in', 7200))
+    return Response(content='', status_code=200)
+
+
+@app.post('/tts/callback')
+async def tts_callback(data: dict = Body(...), token: str = None):
+    """ play.ht reports finished synthesis jobs here, see tts_jobs.py """
+    if not settings.TTS_CALLBACK_URL or not settings.TTS_CALLBACK_TOKEN:
+        raise HTTPException(status_code=404)
+    if not token or not hmac.compare_digest(token.encode('utf-8'), settings.TTS_CALLBACK_TOKEN.encode('utf-8')):
+        raise HTTPException(status_code=401)
+    await tts_jobs.complete(data)
     return Response(content='', status_code=200)
 
 
+def require_admin(x_admin_key: str = Header(None)):
+    if not settings.ADMIN_API_KEY:
+        raise HTTPException(status_code=404)
+    if not hmac.compare_digest(x_admin_key or '', settings.ADMIN_API_KEY):
+        raise HTTPException(status_code=401)
+
+
+@app.get('/admin/users/{username}/messages', dependencies=[Depends(require_admin)])
+def user_messages(username: str, before: datetime = None, before_id: int = None, limit: int = 50, session=Depends(db.get_session)):
+    """ a page of the user's messages, newest first. Pass the returned next as the query to get the following page """
+    user = session.query(db.User).filter(db.User.username == username).first()
+    if user is None:
+        raise HTTPException(status_code=404)
+    limit = max(1, min(limit, 200))
+    messages = db.get_user_messages(session, user.id, before, before_id, limit)
+    page = [
+        {
+            'id': message.id,
+            'direction': 'sent' if message.sender_id == user.id else 'received',
+            'msg_type': message.msg_type,
+            'time_sent': message.time_sent.isoformat() if message.time_sent else None,
+            'content': message.content,
+            'media_id': message.media_id,
+        }
+        for message in messages
+    ]
+    next_page = None
+    if len(messages) == limit:
+        next_page = {'before': page[-1]['time_sent'], 'before_id': page[-1]['id'], 'limit': limit}
+    return {'messages': page, 'next': next_page}
+
+
 @app.get('/wechat')
 async def wechat_get(signature, echostr, timestamp, nonce):
     """ 
@@ -57,52 +124,82 @@ async def get_body(request: Request):
     return await request.body()
 
 @app.post('/wechat')
-def wechat_post(background_tasks: BackgroundTasks, body: bytes = Depends(get_body)):
-    # Messages will be POSTed from the WeChat server to this endpoint
+async def wechat_post(
+    body: bytes = Depends(get_body),
+    timestamp: str = '',
+    nonce: str = '',
+    encrypt_type: str = None,
+    msg_signature: str = None,
+):
+    # Messages will be POSTed from the WeChat server to this endpoint.
+    # Only parse and acknowledge here, everything else runs in the pipeline workers
 
     print('message received')
+    received_at = time.time()
         
-    # Parse the WeChat message XML format
-    message = xmltodict.parse(body)
-    if not message.get('xml'):
+    # Parse the WeChat message XML format, in encrypted mode the message is inside <Encrypt>
+    crypto = wechat_codec.get_crypto() if encrypt_type == 'aes' else None
+    try:
+        with metrics.span('webhook_parse'):
+            if encrypt_type == 'aes':
+                if crypto is None:
+                    raise wechat_codec.MessageError('WECHAT_ENCODING_AES_KEY is not configured')
+                encrypted = wechat_codec.parse_encrypted_field(body)
+                body = crypto.decrypt(encrypted, msg_signature, timestamp, nonce)
+            message = wechat_codec.parse(body)
+    except wechat_codec.MessageError as e:
+        print('invalid message', e)
         return Response(content='', status_code=400)
-    from_user = message['xml'].get('FromUserName')
-    msg_type = message['xml'].get('MsgType')
-    event = message['xml'].get('Event')
-    content = message['xml'].get('Content')
-    event_key = message['xml'].get('EventKey')
-    media_id = message['xml'].get('MediaId')
+    from_user = message.from_user
+    msg_type = message.msg_type
+    event = message.event
+    event_key = message.event_key
+    media_id = message.media_id
 
     # bot state can be one of:
     # 1. listening - ready to receive user messages
     # 2. responding - busy responding
 
     chatbot = EnglishBot(from_user)
-    chatbot.receive_message(message=content, media_id=media_id, msg_type=msg_type)
     # if chatbot.state == 'busy':
     #     reply = '我现在忙着，请稍等'
     #     return chatbot.send_text_response(reply, message)
-    
-    # set bot state as busy immediately in order to ignore further requests if tasks are still processing
-    # in the future, this may depend on a scheduled task to read user messages
-    chatbot.send_busy_status()
 
+    # reply stays None when the answer is sent asynchronously by the pipeline
+    reply = None
     if (event == 'subscribe') or (event == 'CLICK' and event_key == 'tutorial'):
         reply = chatbot.intro_message
-        return chatbot.send_text_response(reply, message)
-    
-    if msg_type == 'text' and chatbot._validate_message(message):
-        background_tasks.add_task(chatbot.respond, content)
-        return Response(content='', status_code=200)
-    
-    if msg_type == 'voice' and media_id:
-        background_tasks.add_task(chatbot.respond_to_audio, media_id)
-        return Response(content='', status_code=200)
-    
-    if event == 'CLICK' and event_key in ('explain', 'english_equivalent'):
+    elif msg_type == 'text' and chatbot._validate_message(message):
+        pass
+    elif msg_type == 'voice' and media_id:
+        pass
+    elif event == 'CLICK' and event_key in ('explain', 'english_equivalent'):
         reply = chatbot.get_auto_response(event_key)
-        return chatbot.send_text_response(reply, message)
-    
-    reply = '对不起， 我不懂'
-    return chatbot.send_text_response(reply, message)
+    else:
+        reply = '对不起， 我不懂'
+
+    if event == 'CLICK':
+        # set before the user's next message can be answered, which a queued job could not guarantee
+        await run_in_threadpool(chatbot.attach_event_message, event_key)
+
+    # retries of a message that is already queued are dropped here, but a
+    # synchronous reply is cheap to render so it is still returned
+    if not await pipeline.submit(message.to_dict(), reply, received_at):
+        print('duplicate message dropped')
+    elif msg_type == 'voice' and media_id and not message.recognition:
+        # download the audio while the message waits for a worker
+        voice_ingest.prefetch(media_id)
+
+    if reply is None:
+        return Response(content='', status_code=200)
+    content = chatbot._format_message(message, reply)
+    if crypto is not None:
+        content = crypto.encrypt(content, timestamp, nonce)
+    return Response(content=content, status_code=200)
+
 
+@app.get('/metrics')
+async def get_metrics():
+    # the collectors read from redis, so render off the event loop
+    content = await run_in_threadpool(metrics.render)
+    return Response(content=content, media_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,81 @@
+"""
+Content-addressed cache of synthesized speech, so that the same sentence in
+the same voice is only sent to play.ht once.
+
+Audio files are kept on local disk under AUDIO_CACHE_DIR, keyed on a hash of
+the prepared text and the voice model, and the least recently used files are
+removed once the directory grows past AUDIO_CACHE_MAX_BYTES. The WeChat
+media_id of an uploaded file is kept in redis until WeChat expires it, so a
+repeated voice reply skips both synthesis and upload.
+"""
+import hashlib
+import os
+import threading
+import settings
+from db import cache
+
+MEDIA_KEY_PREFIX = settings.REDIS_KEY_PREFIX + 'voice_media:'
+
+_evict_lock = threading.Lock()
+
+
+def audio_key(text, model):
+    return hashlib.sha256((model + '\n' + text).encode('utf-8')).hexdigest()
+
+
+def _path(key):
+    return os.path.join(settings.AUDIO_CACHE_DIR, key + '.mp3')
+
+
+def get(key):
+    """ returns the path of the cached audio file, or None """
+    path = _path(key)
+    try:
+        # the modification time doubles as the last access time for eviction
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def put(key, data):
+    """ stores the audio bytes and returns the path of the cached file """
+    os.makedirs(settings.AUDIO_CACHE_DIR, exist_ok=True)
+    path = _path(key)
+    tmp_path = path + '.%s.tmp' % threading.get_ident()
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    evict()
+    return path
+
+
+def evict():
+    with _evict_lock:
+        entries = []
+        total = 0
+        with os.scandir(settings.AUDIO_CACHE_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith('.mp3'):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= settings.AUDIO_CACHE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def get_media_id(key):
+    return cache.get(MEDIA_KEY_PREFIX + key)
+
+
+def set_media_id(key, media_id):
+    cache.set(MEDIA_KEY_PREFIX + key, media_id, ex=settings.WECHAT_MEDIA_TTL)
@@ -0,0 +1,95 @@
+"""
+Process pool for CPU and pipe heavy work, currently the ffmpeg transcodes.
+
+Running them in a few small worker processes keeps the web and worker
+processes from forking themselves for every ffmpeg call and from copying
+audio through pipes while they also serve requests. At most
+CPU_POOL_MAX_PENDING tasks may be submitted at once; past that callers wait
+up to CPU_POOL_QUEUE_TIMEOUT for a slot and then get PoolBusy, so a burst of
+voice messages queues in front of the pool instead of inside it.
+
+Functions run in the pool must be importable module level functions, and the
+workers are started with forkserver so they do not inherit the threads of the
+process using the pool.
+"""
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import settings
+import metrics
+
+_lock = threading.Lock()
+_executor = None
+_slots = threading.BoundedSemaphore(settings.CPU_POOL_MAX_PENDING)
+
+
+class PoolBusy(Exception):
+    """ no slot became free within CPU_POOL_QUEUE_TIMEOUT """
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(
+                    max_workers=settings.CPU_POOL_WORKERS,
+                    mp_context=multiprocessing.get_context('forkserver'),
+                )
+    return _executor
+
+
+def _timed(fn, args, kwargs):
+    """ runs in the pool, returns the result and the time spent on it there """
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def _acquire(name):
+    started = time.perf_counter()
+    if not _slots.acquire(timeout=settings.CPU_POOL_QUEUE_TIMEOUT):
+        metrics.ERRORS.labels('cpu_pool_busy').inc()
+        raise PoolBusy(name)
+    metrics.observe('cpu_pool_wait', time.perf_counter() - started)
+
+
+def _submit(fn, args, kwargs):
+    try:
+        future = _get_executor().submit(_timed, fn, args, kwargs)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def _unpack(name, timed_result):
+    result, elapsed = timed_result
+    metrics.observe('cpu:' + name, elapsed)
+    return result
+
+
+def call(fn, *args, **kwargs):
+    """ runs fn in the pool and blocks until it is done, for code running in threads """
+    _acquire(fn.__name__)
+    return _unpack(fn.__name__, _submit(fn, args, kwargs).result())
+
+
+async def run(fn, *args, **kwargs):
+    """ runs fn in the pool without blocking the event loop """
+    if not _slots.acquire(blocking=False):
+        # only hold a thread while the pool is full
+        await asyncio.get_running_loop().run_in_executor(None, _acquire, fn.__name__)
+    future = _submit(fn, args, kwargs)
+    return _unpack(fn.__name__, await asyncio.wrap_future(future))
+
+
+def shutdown():
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
@@ -1,13 +1,118 @@
+import atexit
+import contextlib
+import contextvars
+import metrics
 import redis
 import settings
-from sqlalchemy import create_engine, desc
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy import bindparam, create_engine, desc, insert, or_, select, text, tuple_, union_all
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Text, UnicodeText
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, String, DateTime, Text, UnicodeText
 from sqlalchemy.sql import func
 
-engine = create_engine(settings.SQLALCHEMY_DATABASE_URL, pool_pre_ping=True)
+class _TimedPool:
+    """ records how long a checkout waited for a connection """
+    engine_name = None
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            metrics.ERRORS.labels('db_pool_timeout').inc()
+            raise
+        finally:
+            metrics.observe('db_pool_wait_' + self.engine_name, time.perf_counter() - started)
+
+class TimedQueuePool(_TimedPool, QueuePool):
+    engine_name = 'sync'
+
+class TimedAsyncQueuePool(_TimedPool, AsyncAdaptedQueuePool):
+    engine_name = 'async'
+
+def _count_checkouts(engine, name):
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.DB_CHECKOUTS.labels(name).inc()
+
+# used from threads: the message writer, the threadpool and scripts
+engine = create_engine(
+    settings.SQLALCHEMY_DATABASE_URL,
+    poolclass=TimedQueuePool,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+_count_checkouts(engine, 'sync')
+
+def _asyncpg_url(url):
+    """ the same postgres database through asyncpg, whichever driver url names """
+    url = make_url(url)
+    if url.get_backend_name() in ('postgres', 'postgresql'):
+        url = url.set(drivername='postgresql+asyncpg')
+    return url
+
+# used on the event loop, see unit_of_work
+async_engine = create_async_engine(
+    _asyncpg_url(settings.ASYNC_DATABASE_URL),
+    poolclass=TimedAsyncQueuePool,
+    pool_size=settings.ASYNC_DB_POOL_SIZE,
+    max_overflow=settings.ASYNC_DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+_count_checkouts(async_engine.sync_engine, 'async')
+
+_current_session = contextvars.ContextVar('db_session', default=None)
+
+@contextlib.asynccontextmanager
+async def unit_of_work():
+    """
+    one AsyncSession for a whole message-handling flow: nested unit_of_work()
+    calls in the same flow get the same session. It is committed when the
+    outermost block exits. A flow spends most of its time waiting on the LLM,
+    so code using the session commits once it is done with it and the
+    connection goes back to the pool in between. Tasks started inside inherit
+    the session, so they must not use it concurrently with the flow.
+    """
+    session = _current_session.get()
+    if session is not None:
+        yield session
+        return
+    session = AsyncSessionLocal()
+    token = _current_session.set(session)
+    try:
+        yield session
+        await session.commit()
+    except BaseException:
+        await session.rollback()
+        raise
+    finally:
+        _current_session.reset(token)
+        await session.close()
+
+def pool_status():
+    """ connections of each engine in this process, for the metrics """
+    status = {}
+    for name, pool in (('sync', engine.pool), ('async', async_engine.sync_engine.pool)):
+        status[name] = {'size': pool.size(), 'checked_out': pool.checkedout(), 'overflow': max(pool.overflow(), 0)}
+    return status
 
 Base = declarative_base()
 
@@ -34,12 +139,92 @@ class Message(Base):
     content = Column(UnicodeText)
     media_id = Column(String) # used by wechat for voice/img/video messages
 
+    __table_args__ = (
+        # per user history, newest first, in either direction
+        Index('ix_messages_receiver_time', 'receiver_id', 'time_sent'),
+        Index('ix_messages_sender_time', 'sender_id', 'time_sent'),
+        # transcripts are written back by media_id, see MessageWriter.set_content
+        Index('ix_messages_media_id', 'media_id'),
+    )
+
 def create_tables():
     Base.metadata.create_all(engine)
 
+def ensure_indexes():
+    """
+    create_all only creates indexes together with a new table, this adds them
+    to an existing one. A migration (see migrate.py), not run on startup: on
+    postgres the indexes are built CONCURRENTLY so writes are not blocked
+    """
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        # the indexes of a partitioned table are created with it, and cannot be built concurrently
+        if connection.dialect.name != 'postgresql' or messages_partitioned(connection):
+            for index in Message.__table__.indexes:
+                index.create(connection, checkfirst=True)
+            return
+        for index in Message.__table__.indexes:
+            # an interrupted concurrent build leaves an invalid index behind that IF NOT EXISTS would keep
+            invalid = connection.execute(text(
+                "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name AND pg_table_is_visible(c.oid) AND NOT i.indisvalid"
+            ), {'name': index.name}).first()
+            if invalid:
+                connection.execute(text('DROP INDEX CONCURRENTLY IF EXISTS %s' % index.name))
+            connection.execute(text('CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON messages (%s)' % (
+                index.name, ', '.join(column.name for column in index.columns)
+            )))
+
 def drop_tables():
     Base.metadata.drop_all(engine)
 
+# users that are created by init_db and never change
+SYSTEM_USERS = ('bot', 'system', 'assistant')
+
+class UserIdCache:
+    """
+    Bounded LRU + TTL cache of username -> users.id, so that logging a message
+    does not need a SELECT on users every time. Pinned entries (the system users)
+    never expire and are not evicted.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        if username in self._pinned:
+            return self._pinned[username]
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            user_id, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[username]
+                return None
+            self._entries.move_to_end(username)
+            return user_id
+
+    def set(self, username, user_id, pinned=False):
+        if pinned:
+            self._pinned[username] = user_id
+            return
+        with self._lock:
+            self._entries[username] = (user_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pinned.clear()
+
+user_ids = UserIdCache(settings.USER_ID_CACHE_SIZE, settings.USER_ID_CACHE_TTL)
+
 def get_or_create_user(session, username):
     user = session.query(User).filter(User.username == username).first()
     if not user:
@@ -47,15 +232,39 @@ def get_or_create_user(session, username):
         session.add(user)
         session.commit()
         session.refresh(user)
+    user_ids.set(username, user.id, pinned=username in SYSTEM_USERS)
     return user
 
-def log_message(session, sender, receiver, **kwargs):
+def get_user_id(session, username):
+    """ same as get_or_create_user(session, username).id, without the query when cached """
+    user_id = user_ids.get(username)
+    if user_id is None:
+        user_id = get_or_create_user(session, username).id
+    return user_id
+
+async def get_user_id_async(session, username):
+    """ get_user_id on an AsyncSession """
+    user_id = user_ids.get(username)
+    if user_id is not None:
+        return user_id
+    user_id = await session.scalar(select(User.id).where(User.username == username))
+    if user_id is None:
+        await session.execute(pg_insert(User).values(username=username).on_conflict_do_nothing(index_elements=['username']))
+        # committed straight away, the message writer references it from another connection
+        await session.commit()
+        user_id = await session.scalar(select(User.id).where(User.username == username))
+    # end the transaction so the connection is not held for the rest of the flow
+    await session.commit()
+    user_ids.set(username, user_id, pinned=username in SYSTEM_USERS)
+    return user_id
+
+def log_message(session, sender_id, receiver_id, **kwargs):
     content=kwargs.get('content')
     msg_type = kwargs.get('msg_type', 'text')
     media_id = kwargs.get('media_id')
     message = Message(
-        sender=sender, 
-        receiver=receiver, 
+        sender_id=sender_id, 
+        receiver_id=receiver_id, 
         msg_type=msg_type, 
         content=content, 
         media_id=media_id
@@ -65,14 +274,294 @@ def log_message(session, sender, receiver, **kwargs):
     session.refresh(message)
     return message
 
+# a core (not ORM) update, so that a list of parameters runs as one executemany
+_SET_CONTENT = (
+    Message.__table__.update()
+    .where(Message.__table__.c.media_id == bindparam('b_media_id'))
+    .where(Message.__table__.c.content.is_(None))
+    .values(content=bindparam('b_content'))
+)
+
+class MessageWriter:
+    """
+    Write-behind buffer for the messages table. Rows are kept in memory and
+    written with one bulk INSERT once batch_size rows are pending or every
+    flush_interval seconds, so logging is off the critical path of a reply.
+
+    If the process dies without close() being called at most flush_interval
+    seconds (or batch_size rows) of messages are lost. If the database falls
+    behind, the caller flushes itself once max_pending rows are buffered and the
+    oldest rows beyond max_pending are dropped. Code on the event loop uses
+    log_nowait, which leaves even that flush to the writer thread.
+    """
+
+    def __init__(self, batch_size, flush_interval, max_pending):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._rows = []
+        self._updates = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    def _append(self, sender_id, receiver_id, kwargs):
+        row = {
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'msg_type': kwargs.get('msg_type', 'text'),
+            'content': kwargs.get('content'),
+            'media_id': kwargs.get('media_id'),
+            # set here rather than by the server so batching does not shift the time
+            'time_sent': datetime.now(timezone.utc),
+        }
+        with self._lock:
+            self._rows.append(row)
+            pending = len(self._rows)
+        self._start()
+        return pending
+
+    def log(self, sender_id, receiver_id, **kwargs):
+        pending = self._append(sender_id, receiver_id, kwargs)
+        if pending >= self.max_pending or self._closed:
+            self._safe_flush()
+        elif pending >= self.batch_size:
+            self._wakeup.set()
+
+    def log_nowait(self, sender_id, receiver_id, **kwargs):
+        """
+        log for the event loop, never writes in the calling thread: a backlog
+        is left to the writer thread, after close() to the atexit flush
+        """
+        if self._append(sender_id, receiver_id, kwargs) >= self.batch_size:
+            self._wakeup.set()
+
+    def set_content(self, media_id, content):
+        """ fills in the content of a logged media message, e.g. the transcript of a voice message """
+        with self._lock:
+            for row in reversed(self._rows):
+                if row['media_id'] == media_id and row['content'] is None:
+                    row['content'] = content
+                    return
+            # already written, update it with the next flush
+            self._updates.append({'b_media_id': media_id, 'b_content': content})
+        self._start()
+        if self._closed:
+            self._safe_flush()
+
+    def flush(self):
+        """ writes out all pending rows, returns the number written """
+        with self._flush_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+                updates, self._updates = self._updates, []
+            if not rows and not updates:
+                return 0
+            try:
+                with metrics.span('db_log', rows=len(rows)), SessionLocal() as session:
+                    if rows:
+                        session.execute(insert(Message), rows)
+                    if updates:
+                        session.execute(_SET_CONTENT, updates)
+                    session.commit()
+            except Exception:
+                with self._lock:
+                    self._rows[:0] = rows
+                    self._updates[:0] = updates
+                    dropped = len(self._rows) - self.max_pending
+                    if dropped > 0:
+                        del self._rows[:dropped]
+                        print('message log dropped %s rows' % dropped)
+                raise
+            return len(rows)
+
+    def pending(self):
+        return len(self._rows) + len(self._updates)
+
+    def close(self):
+        """ flush-on-shutdown hook """
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval * 5)
+        self._safe_flush()
+
+    def _safe_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            traceback.print_exc()
+
+    def _start(self):
+        if self._thread is not None or self._closed:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._safe_flush()
+
+message_writer = MessageWriter(
+    settings.MESSAGE_LOG_BATCH_SIZE,
+    settings.MESSAGE_LOG_FLUSH_INTERVAL,
+    settings.MESSAGE_LOG_MAX_PENDING,
+)
+atexit.register(message_writer.close)
+
 def get_latest_received_message(session, user):
     message = session.query(Message).filter(Message.receiver_id == user.id).order_by(desc('time_sent')).first()
     return message
 
+def get_user_messages(session, user_id, before=None, before_id=None, limit=50):
+    """
+    a page of the messages sent or received by the user, newest first.
+    Pass the time_sent and id of the last message of a page as before and
+    before_id to get the next one
+    """
+    pages = []
+    for column in (Message.sender_id, Message.receiver_id):
+        query = select(Message.id, Message.time_sent).where(column == user_id)
+        if before is not None:
+            query = query.where(tuple_(Message.time_sent, Message.id) < tuple_(before, before_id or 0))
+        # each side is a range scan on its (user, time_sent) index
+        pages.append(query.order_by(desc(Message.time_sent), desc(Message.id)).limit(limit))
+    page = union_all(*pages).subquery()
+    ids = select(page.c.id).order_by(desc(page.c.time_sent), desc(page.c.id)).limit(limit)
+    return (
+        session.query(Message)
+        .filter(Message.id.in_(ids))
+        .order_by(desc(Message.time_sent), desc(Message.id))
+        .all()
+    )
+
+def _conversation_query(user_id, other_id, since, limit):
+    return (
+        select(Message)
+        .where(or_(
+            (Message.sender_id == user_id) & (Message.receiver_id == other_id),
+            (Message.sender_id == other_id) & (Message.receiver_id == user_id),
+        ))
+        .where(Message.time_sent >= since)
+        .where(Message.content.isnot(None))
+        .order_by(desc(Message.time_sent), desc(Message.id))
+        .limit(limit)
+    )
+
+def get_conversation(session, user_id, other_id, since, limit):
+    """ the latest messages between two users sent after since, oldest first """
+    return session.scalars(_conversation_query(user_id, other_id, since, limit)).all()[::-1]
+
+async def get_conversation_async(session, user_id, other_id, since, limit):
+    return (await session.scalars(_conversation_query(user_id, other_id, since, limit))).all()[::-1]
+
+# Partitioning of the messages table by month on time_sent. partition_messages
+# converts an existing table once (python migrate.py partition),
+# create_message_partitions then adds the upcoming months and is run by init_db
+# and periodically by the workers; both do nothing on other databases. Rows
+# outside every monthly partition go to messages_default instead of failing.
+
+def _first_of_month(moment, months=0):
+    month = moment.month - 1 + months
+    return datetime(moment.year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+def messages_partitioned(connection):
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = 'messages' AND pg_table_is_visible(c.oid)"
+    )).first() is not None
+
+def partition_messages(cutoff=None):
+    """
+    one-off migration to a table partitioned by month. The existing rows stay
+    where they are, renamed to messages_legacy and attached as the partition
+    for everything before cutoff (by default the start of next month)
+    """
+    cutoff = cutoff or _first_of_month(datetime.now(timezone.utc), 1)
+    with engine.begin() as connection:
+        if connection.dialect.name != 'postgresql' or messages_partitioned(connection):
+            return False
+        connection.execute(text('UPDATE messages SET time_sent = :moment WHERE time_sent IS NULL'), {'moment': cutoff - timedelta(seconds=1)})
+        connection.execute(text('ALTER TABLE messages RENAME TO messages_legacy'))
+        connection.execute(text('ALTER TABLE messages_legacy RENAME CONSTRAINT messages_pkey TO messages_legacy_pkey'))
+        for index in Message.__table__.indexes:
+            connection.execute(text('ALTER INDEX IF EXISTS %s RENAME TO legacy_%s' % (index.name, index.name)))
+        connection.execute(text('ALTER TABLE messages_legacy DROP CONSTRAINT IF EXISTS messages_sender_id_fkey'))
+        connection.execute(text('ALTER TABLE messages_legacy DROP CONSTRAINT IF EXISTS messages_receiver_id_fkey'))
+        connection.execute(text('ALTER TABLE messages_legacy ALTER COLUMN time_sent SET NOT NULL'))
+
+        # the partition key has to be part of the primary key
+        connection.execute(text(
+            'CREATE TABLE messages (LIKE messages_legacy INCLUDING DEFAULTS, PRIMARY KEY (id, time_sent)) '
+            'PARTITION BY RANGE (time_sent)'
+        ))
+        connection.execute(text('ALTER TABLE messages ADD FOREIGN KEY (sender_id) REFERENCES users (id)'))
+        connection.execute(text('ALTER TABLE messages ADD FOREIGN KEY (receiver_id) REFERENCES users (id)'))
+        connection.execute(text('ALTER SEQUENCE messages_id_seq OWNED BY messages.id'))
+        connection.execute(
+            text('ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO (:cutoff)'),
+            {'cutoff': cutoff},
+        )
+        for index in Message.__table__.indexes:
+            index.create(connection)
+    create_message_partitions(start=cutoff)
+    return True
+
+# 42P07: created by another worker at the same time, 42P17: the month is still
+# covered by messages_legacy, 23514: messages_default already has rows for it
+_PARTITION_EXISTS = ('42P07', '42P17')
+_PARTITION_IN_DEFAULT = '23514'
+
+def create_message_partitions(months_ahead=None, start=None):
+    """
+    creates the default partition and the monthly partitions from start (or
+    now) up to months_ahead months later, returns the number of months covered
+    """
+    months_ahead = settings.MESSAGE_PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    start = _first_of_month(start or datetime.now(timezone.utc))
+    with engine.begin() as connection:
+        if not messages_partitioned(connection):
+            return 0
+        try:
+            with connection.begin_nested():
+                connection.execute(text('CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT'))
+        except DBAPIError as e:
+            if getattr(e.orig, 'pgcode', None) not in _PARTITION_EXISTS:
+                raise
+        created = 0
+        for month in range(months_ahead + 1):
+            begin, end = _first_of_month(start, month), _first_of_month(start, month + 1)
+            try:
+                with connection.begin_nested():
+                    connection.execute(text(
+                        'CREATE TABLE IF NOT EXISTS messages_%s PARTITION OF messages FOR VALUES FROM (:begin) TO (:end)'
+                        % begin.strftime('%Y%m')
+                    ), {'begin': begin, 'end': end})
+                created += 1
+            except DBAPIError as e:
+                pgcode = getattr(e.orig, 'pgcode', None)
+                if pgcode == _PARTITION_IN_DEFAULT:
+                    # the rows have to be moved out of messages_default by hand first
+                    metrics.ERRORS.labels('message_partition').inc()
+                    print('messages_default has rows for %s, partition not created' % begin.strftime('%Y-%m'))
+                elif pgcode not in _PARTITION_EXISTS:
+                    raise
+    return created
+
 def init_db():
+    """ creates the system users and warms the user id cache with them """
+    create_message_partitions()
     session = SessionLocal()
-    system = get_or_create_user(session, 'system')
-    assistant = get_or_create_user(session, 'assistant')
+    for username in SYSTEM_USERS:
+        get_or_create_user(session, username)
     session.close()
     return True
 
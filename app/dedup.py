@@ -0,0 +1,50 @@
+"""
+Drops WeChat webhook retries. WeChat resends the same POST up to three times
+when we do not answer within 5 seconds, so every message is marked as seen
+with an atomic SET NX before any DB or LLM work is queued for it.
+
+Normal messages are keyed on MsgId, events (which have no MsgId) on
+FromUserName + CreateTime.
+"""
+import settings
+from db import cache
+
+KEY_PREFIX = settings.REDIS_KEY_PREFIX + 'msg_seen:'
+SEEN_COUNTER_KEY = settings.REDIS_KEY_PREFIX + 'dedup:seen'
+SUPPRESSED_COUNTER_KEY = settings.REDIS_KEY_PREFIX + 'dedup:suppressed'
+
+
+def message_id(message):
+    msg_id = message.get('MsgId')
+    if msg_id:
+        return msg_id
+    return '%s:%s' % (message.get('FromUserName'), message.get('CreateTime'))
+
+
+def message_key(message):
+    return KEY_PREFIX + message_id(message)
+
+
+def is_duplicate(message):
+    """ marks the message as seen, returns True if it had already been seen """
+    pipe = cache.pipeline(transaction=False)
+    pipe.set(message_key(message), 1, nx=True, ex=settings.DEDUP_TTL)
+    pipe.incr(SEEN_COUNTER_KEY)
+    first_delivery, _ = pipe.execute()
+    if first_delivery:
+        return False
+    cache.incr(SUPPRESSED_COUNTER_KEY)
+    return True
+
+
+def forget(message):
+    """ allows a retry of the message to go through again """
+    cache.delete(message_key(message))
+
+
+def stats():
+    seen, suppressed = cache.mget(SEEN_COUNTER_KEY, SUPPRESSED_COUNTER_KEY)
+    return {
+        'seen': int(seen or 0),
+        'suppressed': int(suppressed or 0),
+    }
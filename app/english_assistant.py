@@ -1,14 +1,20 @@
 import settings
 import wechat
-import requests
 import os
+import traceback
 import voice_assistant
-from langchain.chat_models import ChatOpenAI
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferWindowMemory, RedisChatMessageHistory
+import response_cache
+import llm
+import metrics
+import rate_limit
+import voice_stream
+import voice_ingest
+import work_queue
+from history import ChatHistory
+from segmenter import StreamSegmenter
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.prompts import PromptTemplate
-from db import cache
+from starlette.concurrency import run_in_threadpool
 from wechat import ChatBot
 
 
@@ -66,63 +72,33 @@ PROMPT = PromptTemplate(
 
 def add_user_message(username, message):
     session_id = settings.REDIS_KEY_PREFIX + username
-    history = RedisChatMessageHistory(url=settings.REDIS_URL, session_id=session_id, ttl=86400)
+    history = ChatHistory(session_id)
     history.add_user_message(message)
     return
 
 def add_assistant_message(username, message):
     session_id = settings.REDIS_KEY_PREFIX + username
-    history = RedisChatMessageHistory(url=settings.REDIS_URL, session_id=session_id, ttl=86400)
+    history = ChatHistory(session_id)
     history.add_ai_message(message)
     return
 
-def is_split_point(current_message, token):
-    """
-    takes a token and a current_message and checks to see if
-    the current_message can be split correctly at the token.
-    helps speed up response time in streaming
-    """
-
-    output_message = None
-    leftover_message = None
-    boundary_token = None
-
-    new_message = current_message + token
-    if '\n\n' in new_message[-5:]:
-        boundary_token = '\n\n'
-    # elif '。比如' in new_message[-5:]:
-    #     boundary_token = '。'
-    # elif '。例如' in new_message[-5:]:
-    #     boundary_token = '。'
-
-    if boundary_token:
-        condition1 = len(new_message) > 20 and boundary_token == '\n\n'
-        # condition2 = len(new_message) > 100 and boundary_token == '。'
-        
-        if condition1:
-            boundary_split = new_message[-5:].split(boundary_token)
-
-            output_message = new_message[:-5] + boundary_split[0]
-            leftover_message = boundary_split[1]
-
-    return output_message, leftover_message
-
 class StreamingHandler(BaseCallbackHandler):
-    def __init__(self, response_fn):
-        self.message = ''
-        self.message_chunk = ''
+    def __init__(self, response_fn, received_at=None, segmenter=None):
+        self.segmenter = segmenter or StreamSegmenter()
         self.response_fn = response_fn
+        # when the webhook received the message, for the time_to_first_token metric
+        self.received_at = received_at
 
     def on_llm_new_token(self, token, **kwargs):
-        output_message, leftover_message = is_split_point(self.message_chunk, token)
-        if output_message:
-            self.response_fn(output_message.strip())
-            self.message_chunk = leftover_message
-        else:
-            self.message_chunk += token
-            
+        if self.received_at:
+            metrics.since('time_to_first_token', self.received_at)
+            self.received_at = None
+        for message in self.segmenter.feed(token):
+            self.response_fn(message)
+
     def on_llm_end(self, response, **kwargs):
-        self.response_fn(self.message_chunk.strip())
+        for message in self.segmenter.finish():
+            self.response_fn(message)
 
 INTRO_MESSAGE = """你好！我是你的私人英语助手，帮你理解日常生活中遇到的任何有关英语的问题。你可以使用菜单下的功能：
 
@@ -136,6 +112,19 @@ INTRO_MESSAGE = """你好！我是你的私人英语助手，帮你理解日常
 
 你有什么关于英语的问题吗?"""
 
+AUTO_RESPONSES = {
+    'explain': '[帮我解释下面这个英文句子]\n\n好的，你要我解释什么英文句子？直接发给我就行了',
+    'english_equivalent': '[用英文表达]\n\n好的，你要我教你用英文表达什么中文句子？直接发给我就行了'
+}
+
+ATTACHED_MESSAGES = {
+    'explain': '这句话是什么意思?',
+    'english_equivalent': '怎么用英文表达这句话?'
+}
+
+# sent instead of an answer when the LLM quota is used up
+OVERLOADED_MESSAGE = '现在问我问题的同学太多了，请过一会儿再问我一遍'
+
 class EnglishBot(ChatBot):
 
     def __init__(self, username):
@@ -144,74 +133,123 @@ class EnglishBot(ChatBot):
         self.intro_message = INTRO_MESSAGE
 
     def get_auto_response(self, event_key):
-        predefined_responses = {
-            'explain': '[帮我解释下面这个英文句子]\n\n好的，你要我解释什么英文句子？直接发给我就行了',
-            'english_equivalent': '[用英文表达]\n\n好的，你要我教你用英文表达什么中文句子？直接发给我就行了'
-        }
-
-        attached_messages = {
-            'explain': '这句话是什么意思?',
-            'english_equivalent': '怎么用英文表达这句话?'
-        }
-
-        self.attached_message = attached_messages.get(event_key, '')
-        return predefined_responses.get(event_key)
-
-    def respond(self, user_message, response_type='text'):
-        if self.attached_message:
-            user_message = self.attached_message + '\n' + user_message
-
+        return AUTO_RESPONSES.get(event_key)
+
+    def attach_event_message(self, event_key):
+        """ the menu question is prepended to the next message the user sends """
+        if event_key in ATTACHED_MESSAGES:
+            self.attached_message = ATTACHED_MESSAGES[event_key]
+
+    def respond(self, user_message, response_type='text', voice=None):
+        """
+        text replies are streamed to the user as text messages, voice replies
+        to voice, a voice_stream.VoiceStream (see respond_async)
+        """
+        attached_message = self.pop_attached_message()
+        if attached_message:
+            user_message = attached_message + '\n' + user_message
+
+        message_history = ChatHistory(self.session_cache_key)
+
+        # the answer only depends on the question when there is no conversation to follow up on
+        cacheable = message_history.is_empty()
+        if cacheable:
+            cached_answer = response_cache.lookup(user_message)
+            if cached_answer is not None:
+                return self._respond_from_cache(user_message, cached_answer, message_history, response_type, voice)
+
+        priority = rate_limit.INTERACTIVE if response_type == 'text' else rate_limit.BACKGROUND
+        try:
+            rate_limit.acquire('openai', priority)
+        except rate_limit.RateLimited:
+            print('openai rate limit reached, shedding message from', self.username)
+            self.queue_text_response(OVERLOADED_MESSAGE)
+            self.wait_for_responses()
+            self.state = 'listening'
+            return None
+
+        callbacks = []
         if response_type == 'text':
-            llm = ChatOpenAI(
-                temperature=0.7,
-                model='gpt-3.5-turbo-16k-0613',
-                openai_api_key=settings.OPENAI_API_KEY,
-                max_tokens=2500,
-                streaming=True,
-                callbacks=[StreamingHandler(self.send_async_text_response)]
-            )
-            
-        elif response_type == 'voice':
-            llm = ChatOpenAI(
-                temperature=0.7,
-                model='gpt-3.5-turbo-16k-0613',
-                openai_api_key=settings.OPENAI_API_KEY,
-                max_tokens=2500
-            )
-
-        message_history = RedisChatMessageHistory(url=settings.REDIS_URL, session_id=self.session_cache_key, ttl=86400)
-        memory = ConversationBufferWindowMemory(k=3, ai_prefix='Assistant', human_prefix='Student', chat_memory=message_history)
-        
-        conversation = ConversationChain(
-            prompt=PROMPT,
-            llm=llm, 
-            verbose=settings.ENV == 'dev',
-            memory=memory
-        )
-
-        result = conversation.predict(input=user_message)
+            callbacks.append(StreamingHandler(self.queue_text_response, self.received_at))
+        elif voice is not None:
+            callbacks.append(StreamingHandler(voice.put, self.received_at, voice_stream.new_segmenter()))
+
+        # the chain is shared by all users, the history and callbacks are per call
+        conversation = llm.get_chain(PROMPT, streaming=bool(callbacks))
+        with metrics.span('llm_completion', username=self.username):
+            result = conversation.predict(input=user_message, history=message_history.buffer(), callbacks=callbacks)
+        message_history.add_user_message(user_message)
+        message_history.add_ai_message(result)
+        self.wait_for_responses()
+        # after the reply is out, keep the stored history within the prompt budget
+        self._schedule_compaction(message_history)
         if settings.ENV == 'dev':
             print('Assistant: ', result)
 
-        if response_type == 'voice':
-            self.send_async_voice_response(result)
+        if cacheable:
+            response_cache.store(user_message, result)
 
         # except:
         #     reply = '对不起， 碰到了一点问题。请再试一遍'
         #     result = self.send_async_text_response(reply)
-        self.attached_message = ''
         self.state = 'listening'
         return result
     
-    def respond_to_audio(self, media_id):
-        message = self.get_voice_message(media_id)
+    def _schedule_compaction(self, message_history):
+        """ summarizing is another LLM call, so it is left to a background job """
+        try:
+            if message_history.needs_compaction():
+                work_queue.enqueue('compact_history', {'session_id': message_history.session_id})
+        except Exception:
+            # the answer is already out, buffer() keeps the prompt within budget regardless
+            traceback.print_exc()
+
+    def _respond_from_cache(self, user_message, answer, message_history, response_type, voice=None):
+        message_history.add_user_message(user_message)
+        message_history.add_ai_message(answer)
+
+        # split the same way as a streamed answer
+        if response_type == 'text':
+            segmenter = StreamSegmenter()
+            for message in segmenter.feed(answer) + segmenter.finish():
+                self.queue_text_response(message)
+            self.wait_for_responses()
+        elif voice is not None:
+            segmenter = voice_stream.new_segmenter()
+            for segment in segmenter.feed(answer) + segmenter.finish():
+                voice.put(segment)
+
+        self.state = 'listening'
+        return answer
+
+    async def respond_async(self, user_message, response_type='text'):
+        """
+        runs respond in the threadpool. Voice replies are synthesized and sent
+        segment by segment on the event loop while the answer is being generated
+        """
+        # a returning user whose redis history expired picks up where they left off
+        message_history = ChatHistory(self.session_cache_key)
+        if await run_in_threadpool(message_history.is_empty):
+            await message_history.rehydrate(self.username)
+
+        if response_type != 'voice':
+            return await run_in_threadpool(self.respond, user_message, response_type)
+
+        voice = voice_stream.VoiceStream(self)
+        try:
+            return await run_in_threadpool(self.respond, user_message, response_type, voice)
+        finally:
+            voice.close()
+            await voice.wait()
+
+    async def respond_to_audio(self, media_id):
+        message = await voice_ingest.transcribe(media_id)
         print('transcription:', message)
-        result = self.respond(message)
+        result = await self.respond_async(message)
         return result
 
 def update_menu():
     
-    access_token = cache.get(wechat.TOKEN_CACHE_KEY)
     data = {
         'button': [
             {
@@ -247,7 +285,6 @@ def update_menu():
         ]
     }
 
-    url = f'https://api.weixin.qq.com/cgi-bin/menu/create?access_token={access_token}'
-    response = requests.post(url, data=json.dumps(data, ensure_ascii=False).encode('utf-8')).text
+    response = wechat.api_post('/menu/create', data).text
     return response
 
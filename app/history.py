@@ -0,0 +1,198 @@
+"""
+Conversation history in redis, for the LLM prompt.
+
+langchain's RedisChatMessageHistory opens a new redis connection from the url
+every time it is created; this one uses the db.cache connection pool instead so
+that the number of redis connections stays flat under load.
+
+The prompt gets as many recent messages as fit in HISTORY_TOKEN_BUDGET tokens.
+compact() folds the messages beyond the budget into a running summary stored
+next to the history, so the prompt stays bounded however long messages get.
+It is an extra LLM call, so replies only schedule it as a background job.
+
+Redis only holds the last HISTORY_TTL of a conversation, the messages table
+is the archive. rehydrate() reloads the latest messages from it when a
+returning user's redis history has expired, see EnglishBot.respond_async.
+"""
+import json
+import threading
+import traceback
+from datetime import datetime, timedelta, timezone
+import settings
+import tiktoken
+import llm
+import rate_limit
+import db
+from langchain.memory import RedisChatMessageHistory
+from starlette.concurrency import run_in_threadpool
+from langchain.schema import AIMessage, HumanMessage, get_buffer_string, messages_from_dict, messages_to_dict
+from db import cache
+
+HISTORY_TTL = 86400
+COMPACT_LOCK_TTL = 120
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """ loaded on first use, tiktoken downloads the BPE file unless it is cached; False if that failed """
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    _encoding = tiktoken.encoding_for_model('gpt-3.5-turbo')
+                except Exception:
+                    traceback.print_exc()
+                    print('tiktoken encoding unavailable, estimating tokens from characters')
+                    _encoding = False
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if not encoding:
+        # one token per character overestimates english and roughly matches chinese, so the budget holds
+        return len(text)
+    return len(encoding.encode(text))
+
+
+class ChatHistory(RedisChatMessageHistory):
+
+    def __init__(self, session_id, ttl=HISTORY_TTL, human_prefix='Student', ai_prefix='Assistant'):
+        # deliberately not calling super().__init__, see module docstring
+        self.redis_client = cache
+        self.session_id = session_id
+        self.key_prefix = 'message_store:'
+        self.ttl = ttl
+        self.human_prefix = human_prefix
+        self.ai_prefix = ai_prefix
+
+    @property
+    def summary_key(self):
+        return 'summary:' + self.key
+
+    @property
+    def messages(self):
+        # db.cache already decodes responses to str
+        items = [json.loads(m) for m in self.redis_client.lrange(self.key, 0, -1)[::-1]]
+        return messages_from_dict(items)
+
+    def _lines(self, messages):
+        return [get_buffer_string([m], human_prefix=self.human_prefix, ai_prefix=self.ai_prefix) for m in messages]
+
+    def _split_budget(self, messages, max_tokens):
+        """ index of the oldest message that still fits in the budget, counting from the newest """
+        total = 0
+        lines = self._lines(messages)
+        start = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            total += count_tokens(lines[i]) + 1
+            if total > max_tokens:
+                break
+            start = i
+        return start, lines
+
+    def buffer(self, max_tokens=None):
+        """ the summary of older turns plus the recent messages that fit in the token budget """
+        max_tokens = max_tokens or settings.HISTORY_TOKEN_BUDGET
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.get(self.summary_key)
+        pipe.lrange(self.key, 0, -1)
+        summary, items = pipe.execute()
+
+        messages = messages_from_dict([json.loads(m) for m in items[::-1]])
+        if summary:
+            max_tokens -= count_tokens(summary)
+        start, lines = self._split_budget(messages, max_tokens)
+        recent = '\n'.join(lines[start:])
+        if summary:
+            return 'Summary of the earlier conversation: ' + summary + '\n' + recent
+        return recent
+
+    def _compaction_start(self, messages, max_tokens):
+        start, lines = self._split_budget(messages, max_tokens or settings.HISTORY_TOKEN_BUDGET)
+        # always keep the last exchange verbatim
+        return min(start, len(messages) - 2), lines
+
+    def needs_compaction(self, max_tokens=None):
+        return self._compaction_start(self.messages, max_tokens)[0] > 0
+
+    def compact(self, max_tokens=None):
+        """
+        summarizes the messages that no longer fit in the budget and drops them.
+        Runs as a background job (see pipeline), so replies may be added at
+        the same time: those go to the head of the list and only the
+        summarized tail is trimmed
+        """
+        # two compactions of the same history would summarize the same messages twice
+        lock_key = 'compact_lock:' + self.key
+        if not self.redis_client.set(lock_key, 1, nx=True, ex=COMPACT_LOCK_TTL):
+            return False
+        try:
+            messages = self.messages
+            start, lines = self._compaction_start(messages, max_tokens)
+            if start <= 0:
+                return False
+
+            try:
+                rate_limit.acquire('openai', rate_limit.BACKGROUND, max_wait=0)
+            except rate_limit.RateLimited:
+                # buffer() still keeps the prompt within budget, summarize next time
+                return False
+
+            summary = llm.get_summary_chain().predict(
+                summary=self.redis_client.get(self.summary_key) or '',
+                new_lines='\n'.join(lines[:start]),
+            )
+            pipe = self.redis_client.pipeline()
+            pipe.set(self.summary_key, summary.strip(), ex=self.ttl)
+            # the list is newest first, drop the summarized messages from its end
+            pipe.ltrim(self.key, 0, -start - 1)
+            pipe.execute()
+            return True
+        finally:
+            self.redis_client.delete(lock_key)
+
+    async def rehydrate(self, username, bot='bot'):
+        """
+        loads the user's recent conversation with the bot from the messages
+        table into an empty history, returns the number of messages loaded
+        """
+        since = datetime.now(timezone.utc) - timedelta(days=settings.HISTORY_REHYDRATE_DAYS)
+        async with db.unit_of_work() as session:
+            user_id = await db.get_user_id_async(session, username)
+            bot_id = await db.get_user_id_async(session, bot)
+            rows = await db.get_conversation_async(session, user_id, bot_id, since, settings.HISTORY_REHYDRATE_ROWS)
+            await session.commit()
+
+        # a streamed answer was logged as one row per chunk
+        messages = []
+        for row in rows:
+            message_class = HumanMessage if row.sender_id == user_id else AIMessage
+            if messages and isinstance(messages[-1], message_class):
+                messages[-1].content += '\n\n' + row.content
+            else:
+                messages.append(message_class(content=row.content))
+        # unanswered messages at the end include the one being answered now
+        while messages and isinstance(messages[-1], HumanMessage):
+            messages.pop()
+        if not messages:
+            return 0
+        await run_in_threadpool(self._store, messages)
+        return len(messages)
+
+    def _store(self, messages):
+        pipe = self.redis_client.pipeline()
+        pipe.delete(self.key)
+        # the list is newest first
+        pipe.lpush(self.key, *[json.dumps(m) for m in messages_to_dict(messages)])
+        pipe.expire(self.key, self.ttl)
+        pipe.execute()
+
+    def is_empty(self):
+        return not self.redis_client.exists(self.key, self.summary_key)
+
+    def clear(self):
+        self.redis_client.delete(self.key, self.summary_key)
@@ -0,0 +1,56 @@
+"""
+Process-wide HTTP clients for outbound API calls (WeChat etc).
+Connections are kept alive and pooled so that each call does not pay
+for a new TCP + TLS handshake.
+"""
+import threading
+import httpx
+import settings
+
+_lock = threading.Lock()
+_client = None
+_async_client = None
+
+
+def _client_options():
+    return dict(
+        http2=settings.HTTP2_ENABLED,
+        limits=httpx.Limits(
+            max_connections=settings.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(settings.HTTP_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT),
+    )
+
+
+def get_client():
+    """ sync client, safe to share between threads """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = httpx.Client(**_client_options())
+    return _client
+
+
+def get_async_client():
+    """ asyncio client, bound to the running event loop of this process """
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(**_client_options())
+    return _async_client
+
+
+def close():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
+async def aclose():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
@@ -0,0 +1,78 @@
+"""
+Long-lived LLM objects shared by every request in the process.
+
+The chat models and chains hold no per-user state, so they are built once
+and the per-user parts (conversation history, streaming callbacks) are passed
+in on every call. All OpenAI requests go through one pooled requests session.
+"""
+import threading
+import openai
+import requests
+import settings
+from requests.adapters import HTTPAdapter
+from langchain.chat_models import ChatOpenAI
+from langchain.chains import LLMChain
+from langchain.memory.prompt import SUMMARY_PROMPT
+
+CHAT_MODEL = 'gpt-3.5-turbo-16k-0613'
+
+_lock = threading.Lock()
+_chains = {}
+
+
+def _openai_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.OPENAI_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+openai.api_base = settings.OPENAI_API_BASE
+openai.requestssession = _openai_session()
+
+
+def get_chat_model(streaming=False, max_tokens=2500):
+    return ChatOpenAI(
+        temperature=0.7,
+        model=CHAT_MODEL,
+        openai_api_key=settings.OPENAI_API_KEY,
+        openai_api_base=settings.OPENAI_API_BASE,
+        max_tokens=max_tokens,
+        streaming=streaming,
+    )
+
+
+def get_chain(prompt, streaming=False):
+    """
+    returns a shared LLMChain for the prompt. Callers pass the conversation
+    history as a prompt variable and their callbacks to predict()
+    """
+    key = (prompt.template, streaming)
+    chain = _chains.get(key)
+    if chain is None:
+        with _lock:
+            chain = _chains.get(key)
+            if chain is None:
+                chain = LLMChain(
+                    prompt=prompt,
+                    llm=get_chat_model(streaming=streaming),
+                    verbose=settings.ENV == 'dev',
+                )
+                _chains[key] = chain
+    return chain
+
+
+def get_summary_chain():
+    """ progressive summary of a conversation, takes the previous summary and the new lines """
+    key = (SUMMARY_PROMPT.template, 'summary')
+    chain = _chains.get(key)
+    if chain is None:
+        with _lock:
+            chain = _chains.get(key)
+            if chain is None:
+                chain = LLMChain(
+                    prompt=SUMMARY_PROMPT,
+                    llm=get_chat_model(max_tokens=settings.HISTORY_SUMMARY_MAX_TOKENS),
+                )
+                _chains[key] = chain
+    return chain
@@ -0,0 +1,124 @@
+"""
+Prometheus metrics for the message pipeline, served on /metrics (and on
+WORKER_METRICS_PORT by worker.py).
+
+STAGE_SECONDS has one series per stage of a message's life. time_to_first_token
+and time_to_first_chunk are measured from the moment the webhook received the
+message, the others are the duration of the stage itself. span() times a stage
+and, with TRACE_SPANS on, also prints it as a tracing span.
+
+Queue depths, database pool usage and the redis backed counters (dedup, response cache, rate limit
+buckets) are read when the endpoint is scraped.
+"""
+import contextlib
+import os
+import time
+import traceback
+import settings
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+
+STAGE_SECONDS = Histogram(
+    'wechatbot_stage_seconds',
+    'Latency of each stage of handling a message',
+    ['stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80),
+)
+ERRORS = Counter('wechatbot_errors_total', 'Failed operations', ['stage'])
+RETRIES = Counter('wechatbot_retries_total', 'Retried operations', ['operation'])
+DB_CHECKOUTS = Counter('wechatbot_db_checkouts_total', 'Connections checked out of the database pools', ['engine'])
+
+
+def observe(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def since(stage, started_at):
+    """ records the time from started_at (a time.time() timestamp) until now """
+    if started_at:
+        observe(stage, time.time() - started_at)
+
+
+@contextlib.contextmanager
+def span(stage, **attributes):
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        ERRORS.labels(stage).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        observe(stage, elapsed)
+        if settings.TRACE_SPANS:
+            details = ' '.join('%s=%s' % item for item in attributes.items())
+            print('span %s %.1fms %s' % (stage, elapsed * 1000, details))
+
+
+class QueueCollector:
+    """ gauges that are read from redis and the in-process queues on every scrape """
+
+    def collect(self):
+        # imported here, these modules import metrics themselves
+        import db
+        import dedup
+        import outbox
+        import rate_limit
+        import response_cache
+        import work_queue
+
+        depth = GaugeMetricFamily('wechatbot_queue_depth', 'Items waiting in each queue', labels=['queue'])
+        try:
+            for name, value in work_queue.stats().items():
+                depth.add_metric(['jobs_' + name], value)
+        except Exception:
+            traceback.print_exc()
+        depth.add_metric(['outbox'], outbox.pending())
+        depth.add_metric(['message_log'], db.message_writer.pending())
+        yield depth
+
+        connections = GaugeMetricFamily('wechatbot_db_connections', 'Database pool connections of this process', labels=['engine', 'kind'])
+        for engine_name, status in db.pool_status().items():
+            for kind, value in status.items():
+                connections.add_metric([engine_name, kind], value)
+        yield connections
+
+        try:
+            counters = GaugeMetricFamily('wechatbot_dedup_messages', 'Webhook deliveries seen and suppressed as retries', labels=['kind'])
+            for name, value in dedup.stats().items():
+                counters.add_metric([name], value)
+            yield counters
+
+            cache_stats = response_cache.stats()
+            hits = GaugeMetricFamily('wechatbot_response_cache', 'Response cache lookups and size', labels=['kind'])
+            for name in ('exact_hits', 'similar_hits', 'misses', 'entries'):
+                hits.add_metric([name], cache_stats[name])
+            yield hits
+            yield GaugeMetricFamily('wechatbot_response_cache_hit_rate', 'Response cache hit rate', value=cache_stats['hit_rate'])
+
+            usage = GaugeMetricFamily('wechatbot_rate_limit_utilization', 'Share of each rate limit bucket in use', labels=['bucket'])
+            for bucket, value in rate_limit.utilization().items():
+                usage.add_metric([bucket], value)
+            yield usage
+        except Exception:
+            traceback.print_exc()
+
+
+_collector_registered = False
+
+
+def register_collectors():
+    """ called once by the process serving the metrics """
+    global _collector_registered
+    if not _collector_registered:
+        REGISTRY.register(QueueCollector())
+        _collector_registered = True
+
+
+def render():
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(QueueCollector())
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
@@ -0,0 +1,44 @@
+"""
+Database migrations that are too slow or take too many locks to run on every
+startup. Run them once from the app directory, with the same environment as
+the bot:
+
+    python migrate.py indexes              # add the messages indexes to an existing table
+    python migrate.py partition            # convert messages to monthly partitions
+    python migrate.py partition --cutoff 2024-01-01
+
+Both are safe to run again. partition takes an exclusive lock on messages
+while it renames the table, so stop the web nodes and workers first; the
+existing rows stay in messages_legacy for everything before the cutoff
+(default: the start of next month).
+"""
+import argparse
+from datetime import datetime, timezone
+import db
+
+
+def main():
+    parser = argparse.ArgumentParser(description='wechatbot database migrations')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('indexes', help='create missing messages indexes concurrently')
+    partition = commands.add_parser('partition', help='partition the messages table by month')
+    partition.add_argument('--cutoff', help='YYYY-MM-DD, the first day of a month')
+    args = parser.parse_args()
+
+    if args.command == 'indexes':
+        db.ensure_indexes()
+        print('indexes are up to date')
+    elif args.command == 'partition':
+        cutoff = None
+        if args.cutoff:
+            cutoff = datetime.strptime(args.cutoff, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+            if cutoff.day != 1:
+                parser.error('--cutoff must be the first day of a month')
+        if db.partition_messages(cutoff):
+            print('messages is now partitioned by month')
+        else:
+            print('messages is already partitioned, or the database is not postgres')
+
+
+if __name__ == '__main__':
+    main()
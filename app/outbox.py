@@ -0,0 +1,136 @@
+"""
+Per-user ordered queue of outgoing text messages.
+
+The streaming callback only appends to the user's outbox, and a pool of
+OUTBOX_SENDERS threads shared by all users delivers the messages, so the LLM
+stream never waits on the WeChat API and the number of threads does not grow
+with the number of active users. An outbox is handed to one sender at a time,
+which keeps each user's messages in order. Messages that pile up while a send
+is in flight are coalesced into one (up to STREAM_MAX_CHARS), and failed sends
+are retried with jittered exponential backoff. A drained outbox is dropped.
+"""
+import queue
+import random
+import threading
+import time
+import traceback
+from collections import deque
+import settings
+import metrics
+
+_outboxes = {}
+_registry_lock = threading.Lock()
+# outboxes with messages to send, each one is on it at most once
+_ready = queue.SimpleQueue()
+_senders = []
+
+
+class Outbox:
+
+    def __init__(self, username):
+        self.username = username
+        self.closed = False
+        self._queue = deque()
+        # waiting on _ready or being sent from
+        self._scheduled = False
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return f'<Outbox for {self.username} pending={len(self._queue)}>'
+
+    def put(self, message, send_fn):
+        """
+        send_fn: takes the message, returns True once it was delivered.
+        returns False if the outbox has already been dropped
+        """
+        with self._cond:
+            if self.closed:
+                return False
+            self._queue.append((message, send_fn))
+            if not self._scheduled:
+                self._scheduled = True
+                _ready.put(self)
+            return True
+
+    def wait(self, timeout=None):
+        """ blocks until everything queued so far has been sent or given up on """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._scheduled, timeout)
+
+    def _take(self):
+        message, send_fn = self._queue.popleft()
+        while self._queue and len(message) + 2 + len(self._queue[0][0]) <= settings.STREAM_MAX_CHARS:
+            next_message, send_fn = self._queue.popleft()
+            message += '\n\n' + next_message
+        return message, send_fn
+
+    def send_next(self):
+        """ delivers the next (coalesced) message, run by a sender thread """
+        with self._cond:
+            message, send_fn = self._take()
+        self._deliver(message, send_fn)
+        with _registry_lock, self._cond:
+            if self._queue:
+                # behind the other users, so one long answer does not hold up everyone else
+                _ready.put(self)
+                return
+            self._scheduled = False
+            self.closed = True
+            if _outboxes.get(self.username) is self:
+                del _outboxes[self.username]
+            self._cond.notify_all()
+
+    def _deliver(self, message, send_fn):
+        for attempt in range(1, settings.OUTBOX_MAX_ATTEMPTS + 1):
+            try:
+                if send_fn(message):
+                    return True
+            except Exception:
+                traceback.print_exc()
+            if attempt < settings.OUTBOX_MAX_ATTEMPTS:
+                metrics.RETRIES.labels('wechat_send').inc()
+                time.sleep(random.uniform(0, settings.OUTBOX_RETRY_BASE * 2 ** attempt))
+        print('outbox gave up on message for', self.username)
+        metrics.ERRORS.labels('wechat_send').inc()
+        return False
+
+
+def _send_loop():
+    while True:
+        outbox = _ready.get()
+        try:
+            outbox.send_next()
+        except Exception:
+            traceback.print_exc()
+
+
+def _start_senders():
+    """ called with _registry_lock held """
+    while len(_senders) < settings.OUTBOX_SENDERS:
+        thread = threading.Thread(target=_send_loop, name='outbox-sender-%s' % len(_senders), daemon=True)
+        thread.start()
+        _senders.append(thread)
+
+
+def send(username, send_fn, message):
+    """ queues message for username behind anything that is still pending """
+    while True:
+        with _registry_lock:
+            _start_senders()
+            outbox = _outboxes.get(username)
+            if outbox is None:
+                outbox = _outboxes[username] = Outbox(username)
+        if outbox.put(message, send_fn):
+            return outbox
+
+
+def wait(username, timeout=None):
+    outbox = _outboxes.get(username)
+    if outbox is None:
+        return True
+    return outbox.wait(timeout)
+
+
+def pending():
+    """ messages waiting to be sent in this process """
+    return sum(len(outbox._queue) for outbox in list(_outboxes.values()))
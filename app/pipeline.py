@@ -0,0 +1,157 @@
+"""
+Async worker stage for inbound WeChat messages.
+
+The webhook only parses the XML and acknowledges WeChat; logging, typing
+indicators and LLM work are queued on the work_queue stream and handled by
+the workers below, either inside the web process or in worker.py. Replies
+queue a 'compact_history' job when the conversation outgrew the prompt budget.
+"""
+import asyncio
+import functools
+import traceback
+import settings
+import db
+import metrics
+import dedup
+import work_queue
+import user_turns
+import voice_ingest
+from starlette.concurrency import run_in_threadpool
+from english_assistant import EnglishBot
+from history import ChatHistory
+from db import cache
+
+# how far a message got, so that a retried job does not log or answer it twice
+PROGRESS_PREFIX = settings.REDIS_KEY_PREFIX + 'msg_progress:'
+LOGGED = 'logged'
+QUEUED = 'queued'
+
+_worker = None
+_worker_task = None
+
+
+async def handle_message(message, reply=None, received_at=None):
+    """
+    message: the parsed <xml> fields of the WeChat POST
+    reply: the text already returned synchronously to WeChat, if any
+    received_at: when the webhook received the message, for the latency metrics
+    """
+    # one database session for everything done on the event loop for this message
+    async with db.unit_of_work():
+        await _handle_message(message, reply, received_at)
+
+
+def _set_progress(key, progress):
+    # a retry can come as late as the last reclaim of the job
+    cache.set(key, progress, ex=int(work_queue.redelivery_window()))
+
+
+async def _handle_message(message, reply, received_at):
+    chatbot = EnglishBot(message.get('FromUserName'))
+    chatbot.received_at = received_at
+    msg_type = message.get('MsgType')
+    # with WeChat's speech recognition enabled voice messages come with a transcript
+    content = message.get('Content') or message.get('Recognition')
+    media_id = message.get('MediaId')
+
+    # a retried job skips the steps that already happened
+    progress_key = PROGRESS_PREFIX + dedup.message_id(message)
+    progress = await run_in_threadpool(cache.get, progress_key)
+
+    if progress is None:
+        await chatbot.receive_message_async(message=content, media_id=media_id, msg_type=msg_type)
+        if reply is not None:
+            # menu clicks already attached their question in the webhook
+            await chatbot.log_text_response_async(reply)
+        await run_in_threadpool(_set_progress, progress_key, LOGGED)
+
+    if reply is not None:
+        return
+
+    if progress != QUEUED:
+        if msg_type == 'voice' and not content:
+            # the typing indicator goes out while the audio is transcribed
+            _, content = await asyncio.gather(chatbot.send_busy_status_async(), voice_ingest.transcribe(media_id))
+            print('transcription:', content)
+        else:
+            await chatbot.send_busy_status_async()
+        if not content:
+            return
+        # messages sent while a reply is in progress are answered together afterwards
+        await run_in_threadpool(user_turns.push, chatbot.username, content)
+        await run_in_threadpool(_set_progress, progress_key, QUEUED)
+
+    await user_turns.take_turns(chatbot.username, functools.partial(_respond, chatbot))
+
+
+async def _respond(chatbot, text):
+    """ answers one turn, failing it (and so retrying the job) only if nothing was sent yet """
+    replies_sent = chatbot.replies_sent
+    try:
+        await chatbot.respond_async(text)
+    except Exception:
+        if chatbot.replies_sent == replies_sent:
+            # the retry of the job answers it from the pending list
+            await run_in_threadpool(user_turns.requeue, chatbot.username, text)
+            raise
+        # part of the answer is out, answering again would send it twice
+        traceback.print_exc()
+        metrics.ERRORS.labels('respond_after_reply').inc()
+
+
+async def _handle_message_job(payload):
+    await handle_message(payload['message'], payload.get('reply'), payload.get('received_at'))
+
+
+async def _compact_history_job(payload):
+    try:
+        await run_in_threadpool(ChatHistory(payload['session_id']).compact)
+    except Exception:
+        # a retry would only spend more tokens, the next reply schedules another one
+        traceback.print_exc()
+        metrics.ERRORS.labels('compact_history').inc()
+
+
+HANDLERS = {
+    'message': _handle_message_job,
+    'compact_history': _compact_history_job,
+}
+
+# housekeeping run by every worker, see work_queue.Worker
+PERIODIC = [
+    (settings.MESSAGE_PARTITION_INTERVAL, db.create_message_partitions),
+]
+
+
+def _ingest(message, reply, received_at):
+    if dedup.is_duplicate(message):
+        return False
+    try:
+        work_queue.enqueue('message', {'message': message, 'reply': reply, 'received_at': received_at})
+    except Exception:
+        # the message was never queued, so let WeChat's retry through
+        dedup.forget(message)
+        raise
+    return True
+
+
+async def submit(message, reply=None, received_at=None):
+    """ queues the message for the workers, returns False for a WeChat retry """
+    return await run_in_threadpool(_ingest, message, reply, received_at)
+
+
+def start(concurrency=None):
+    """ starts a worker inside the current process if configured to """
+    global _worker, _worker_task
+    if not settings.PIPELINE_EMBEDDED_WORKER:
+        return
+    _worker = work_queue.Worker(HANDLERS, concurrency=concurrency, periodic=PERIODIC)
+    _worker_task = asyncio.create_task(_worker.run())
+
+
+async def stop():
+    """ let in flight messages finish, queued ones stay on the stream """
+    if _worker is None:
+        return
+    _worker.stop()
+    await _worker_task
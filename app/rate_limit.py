@@ -0,0 +1,99 @@
+"""
+Token bucket rate limiting in redis, shared by every web and worker process.
+
+Each bucket refills at its per-minute quota and allows bursts up to one
+minute's worth. Callers wait (queue) for a token up to RATE_LIMIT_MAX_WAIT and
+get RateLimited after that, so they can shed load with a canned reply.
+Interactive work (text replies) can use the whole bucket, background work
+(voice) leaves RATE_LIMIT_BACKGROUND_RESERVE of it for interactive work.
+"""
+import asyncio
+import time
+import settings
+from starlette.concurrency import run_in_threadpool
+from db import cache
+
+KEY_PREFIX = settings.REDIS_KEY_PREFIX + 'ratelimit:'
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+# name: requests per minute
+BUCKETS = {
+    'wechat': settings.WECHAT_RATE_LIMIT_PER_MINUTE,
+    'openai': settings.OPENAI_RATE_LIMIT_PER_MINUTE,
+}
+
+# refills the bucket for the time passed (on the redis clock so nodes agree)
+# and takes cost tokens if that leaves at least reserve in the bucket.
+# returns {taken, seconds to wait, tokens left}
+_TAKE_SCRIPT = cache.register_script("""
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local taken = 0
+local wait = 0
+if tokens - cost >= reserve then
+    tokens = tokens - cost
+    taken = 1
+else
+    wait = (cost + reserve - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) * 2 + 1)
+return {taken, tostring(wait), tostring(tokens)}
+""")
+
+
+class RateLimited(Exception):
+    pass
+
+
+def _take(bucket, cost, priority):
+    per_minute = BUCKETS[bucket]
+    reserve = per_minute * settings.RATE_LIMIT_BACKGROUND_RESERVE if priority == BACKGROUND else 0
+    taken, wait, tokens = _TAKE_SCRIPT(keys=[KEY_PREFIX + bucket], args=[per_minute, per_minute / 60, cost, reserve])
+    return bool(taken), float(wait)
+
+
+def acquire(bucket, priority=INTERACTIVE, cost=1, max_wait=None):
+    """ blocks until the bucket has a token, raises RateLimited after max_wait seconds """
+    max_wait = settings.RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait
+    deadline = time.monotonic() + max_wait
+    while True:
+        taken, wait = _take(bucket, cost, priority)
+        if taken:
+            return
+        if time.monotonic() + wait > deadline:
+            raise RateLimited(bucket)
+        time.sleep(wait)
+
+
+async def acquire_async(bucket, priority=INTERACTIVE, cost=1, max_wait=None):
+    max_wait = settings.RATE_LIMIT_MAX_WAIT if max_wait is None else max_wait
+    deadline = time.monotonic() + max_wait
+    while True:
+        taken, wait = await run_in_threadpool(_take, bucket, cost, priority)
+        if taken:
+            return
+        if time.monotonic() + wait > deadline:
+            raise RateLimited(bucket)
+        await asyncio.sleep(wait)
+
+
+def utilization():
+    """ share of each bucket currently used up, 0 (idle) to 1 (exhausted) """
+    result = {}
+    for bucket, per_minute in BUCKETS.items():
+        _, _, tokens = _TAKE_SCRIPT(keys=[KEY_PREFIX + bucket], args=[per_minute, per_minute / 60, 0, 0])
+        result[bucket] = 1 - float(tokens) / per_minute
+    return result
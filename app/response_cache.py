@@ -0,0 +1,172 @@
+"""
+Cache of LLM answers for questions students ask over and over again
+("bite the bullet 是什么意思?" and the examples in the intro message).
+
+Questions are normalized (full/half width, traditional/simplified, case,
+punctuation and spacing around chinese text) and looked up by exact match first. Optionally a
+character trigram index finds near-duplicates above a Jaccard similarity
+threshold. Entries live in redis with a TTL, and the least recently used
+entries are evicted once RESPONSE_CACHE_MAX_ENTRIES is reached.
+
+Only questions asked without conversation history should go through here,
+since the answer to a follow-up question depends on what came before.
+"""
+import hashlib
+import re
+import time
+import unicodedata
+import settings
+from collections import Counter
+from hanziconv import HanziConv
+from db import cache
+
+KEY_PREFIX = settings.REDIS_KEY_PREFIX + 'rcache:'
+ENTRY_PREFIX = KEY_PREFIX + 'entry:'
+GRAM_PREFIX = KEY_PREFIX + 'gram:'
+LRU_KEY = KEY_PREFIX + 'lru'
+EXACT_HITS_KEY = KEY_PREFIX + 'hits:exact'
+SIMILAR_HITS_KEY = KEY_PREFIX + 'hits:similar'
+MISSES_KEY = KEY_PREFIX + 'misses'
+
+# candidates scored exactly after counting shared trigrams
+MAX_CANDIDATES = 5
+
+_APOSTROPHES = re.compile('[\u2018\u2019\u02bc`]')
+# an apostrophe that is not inside a word is a quote
+_QUOTES = re.compile(r"(?<!\w)'+|'+(?!\w)")
+_SEPARATORS = re.compile(r"(?:[^\w']|_)+")
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_CJK_SPACES = re.compile(' (?=[%s])|(?<=[%s]) ' % (_CJK, _CJK))
+
+
+def normalize(question):
+    """
+    English keeps its apostrophes and single spaces between words ("it's" and
+    "its", "a part" and "apart" are different questions), spaces next to
+    chinese text are dropped since students are not consistent about them
+    """
+    text = unicodedata.normalize('NFKC', question)
+    text = HanziConv.toSimplified(text).lower()
+    text = _APOSTROPHES.sub("'", text)
+    text = _QUOTES.sub(' ', text)
+    text = _SEPARATORS.sub(' ', text)
+    return _CJK_SPACES.sub('', text).strip()
+
+
+def ngrams(text, n=3):
+    if len(text) <= n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _digest(normalized):
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def _hit(digest, counter_key):
+    pipe = cache.pipeline(transaction=False)
+    pipe.zadd(LRU_KEY, {digest: time.time()})
+    pipe.expire(ENTRY_PREFIX + digest, settings.RESPONSE_CACHE_TTL)
+    pipe.incr(counter_key)
+    pipe.execute()
+
+
+def _find_similar(normalized):
+    grams = ngrams(normalized)
+    pipe = cache.pipeline(transaction=False)
+    for gram in grams:
+        pipe.smembers(GRAM_PREFIX + gram)
+    shared = Counter()
+    for members in pipe.execute():
+        shared.update(members)
+    if not shared:
+        return None, None
+
+    candidates = [digest for digest, _ in shared.most_common(MAX_CANDIDATES)]
+    pipe = cache.pipeline(transaction=False)
+    for digest in candidates:
+        pipe.hmget(ENTRY_PREFIX + digest, 'answer', 'ngrams')
+
+    best_digest, best_answer, best_score = None, None, 0
+    for digest, (answer, gram_count) in zip(candidates, pipe.execute()):
+        if answer is None:
+            # expired entry still referenced by the index
+            continue
+        score = shared[digest] / (len(grams) + int(gram_count) - shared[digest])
+        if score > best_score:
+            best_digest, best_answer, best_score = digest, answer, score
+
+    if best_score >= settings.RESPONSE_CACHE_SIMILARITY_THRESHOLD:
+        return best_digest, best_answer
+    return None, None
+
+
+def lookup(question):
+    """ returns the cached answer for the question, or None """
+    if not settings.RESPONSE_CACHE_ENABLED:
+        return None
+    normalized = normalize(question)
+    digest = _digest(normalized)
+    answer = cache.hget(ENTRY_PREFIX + digest, 'answer')
+    if answer is not None:
+        _hit(digest, EXACT_HITS_KEY)
+        return answer
+
+    if settings.RESPONSE_CACHE_SIMILARITY:
+        digest, answer = _find_similar(normalized)
+        if answer is not None:
+            _hit(digest, SIMILAR_HITS_KEY)
+            return answer
+
+    cache.incr(MISSES_KEY)
+    return None
+
+
+def store(question, answer):
+    if not settings.RESPONSE_CACHE_ENABLED or not answer:
+        return
+    normalized = normalize(question)
+    digest = _digest(normalized)
+    grams = ngrams(normalized)
+
+    pipe = cache.pipeline(transaction=False)
+    pipe.hset(ENTRY_PREFIX + digest, mapping={'question': normalized, 'answer': answer, 'ngrams': len(grams)})
+    pipe.expire(ENTRY_PREFIX + digest, settings.RESPONSE_CACHE_TTL)
+    pipe.zadd(LRU_KEY, {digest: time.time()})
+    if settings.RESPONSE_CACHE_SIMILARITY:
+        for gram in grams:
+            pipe.sadd(GRAM_PREFIX + gram, digest)
+            pipe.expire(GRAM_PREFIX + gram, settings.RESPONSE_CACHE_TTL)
+    pipe.execute()
+    _evict()
+
+
+def _evict():
+    overflow = cache.zcard(LRU_KEY) - settings.RESPONSE_CACHE_MAX_ENTRIES
+    if overflow <= 0:
+        return
+    evicted = [digest for digest, _ in cache.zpopmin(LRU_KEY, overflow)]
+    pipe = cache.pipeline(transaction=False)
+    for digest in evicted:
+        pipe.hget(ENTRY_PREFIX + digest, 'question')
+    questions = pipe.execute()
+
+    pipe = cache.pipeline(transaction=False)
+    for digest, question in zip(evicted, questions):
+        pipe.delete(ENTRY_PREFIX + digest)
+        if question is not None:
+            for gram in ngrams(question):
+                pipe.srem(GRAM_PREFIX + gram, digest)
+    pipe.execute()
+
+
+def stats():
+    exact, similar, misses = [int(v or 0) for v in cache.mget(EXACT_HITS_KEY, SIMILAR_HITS_KEY, MISSES_KEY)]
+    lookups = exact + similar + misses
+    return {
+        'exact_hits': exact,
+        'similar_hits': similar,
+        'misses': misses,
+        'hit_rate': (exact + similar) / lookups if lookups else 0.0,
+        'entries': cache.zcard(LRU_KEY),
+    }
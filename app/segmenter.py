@@ -0,0 +1,100 @@
+"""
+Splits a stream of LLM tokens into messages that can be sent while the rest
+of the answer is still being generated.
+
+Messages are split at paragraph breaks, like the answers in the prompt
+examples. Sentence boundaries (。！？ and . ! ? followed by a space) are used to
+get a first message out within first_flush_seconds, and to keep messages under
+max_chars when the model writes long paragraphs. Each token is scanned once,
+so the cost per token does not grow with the length of the answer.
+"""
+import time
+import settings
+
+CHINESE_ENDINGS = '。！？；'
+ENGLISH_ENDINGS = '.!?;'
+# closing quotes and brackets that belong to the sentence before them
+CLOSERS = '"\'”’」』）)'
+
+
+class StreamSegmenter:
+
+    def __init__(self, min_chars=None, max_chars=None, first_flush_seconds=None):
+        self.min_chars = min_chars or settings.STREAM_MIN_CHARS
+        self.max_chars = max_chars or settings.STREAM_MAX_CHARS
+        self.first_flush_seconds = settings.STREAM_FIRST_FLUSH_SECONDS if first_flush_seconds is None else first_flush_seconds
+        self._started = time.monotonic()
+        self._emitted = False
+        self._reset('')
+
+    def _reset(self, text):
+        self._parts = [text] if text else []
+        self._length = len(text)
+        self._prev = ''
+        self._prev2 = ''
+        # the first paragraph break after min_chars, the last sentence end and space within max_chars
+        self._paragraph_end = None
+        self._sentence_end = None
+        self._space_end = None
+        for i, char in enumerate(text):
+            self._scan(i, char)
+
+    def _scan(self, i, char):
+        if char == '\n' and self._prev == '\n':
+            if self._paragraph_end is None or self._paragraph_end < self.min_chars:
+                self._paragraph_end = i - 1
+        elif i < self.max_chars:
+            if char in CHINESE_ENDINGS or char == '\n':
+                self._sentence_end = i + 1
+            elif char in CLOSERS and self._sentence_end == i:
+                self._sentence_end = i + 1
+            elif char.isspace():
+                self._space_end = i
+                # "1. " starts a list item rather than ending a sentence
+                if self._prev and self._prev in ENGLISH_ENDINGS and not self._prev2.isdigit():
+                    self._sentence_end = i
+        self._prev2 = self._prev
+        self._prev = char
+
+    def _cut(self, index):
+        text = ''.join(self._parts)
+        self._reset(text[index:].lstrip())
+        self._emitted = True
+        return text[:index].strip()
+
+    def _next_chunk(self):
+        if self._paragraph_end is not None and self.min_chars <= self._paragraph_end <= self.max_chars:
+            return self._cut(self._paragraph_end)
+        if self._length >= self.max_chars:
+            for end in (self._sentence_end, self._space_end):
+                if end and end >= self.min_chars:
+                    return self._cut(end)
+            return self._cut(self.max_chars)
+        if (not self._emitted and self._sentence_end
+                and time.monotonic() - self._started >= self.first_flush_seconds):
+            return self._cut(self._sentence_end)
+        return None
+
+    def feed(self, token):
+        """ adds a token, returns the list of messages that are ready to be sent """
+        offset = self._length
+        self._parts.append(token)
+        self._length += len(token)
+        for i, char in enumerate(token, offset):
+            self._scan(i, char)
+
+        chunks = []
+        chunk = self._next_chunk()
+        while chunk is not None:
+            if chunk:
+                chunks.append(chunk)
+            chunk = self._next_chunk()
+        return chunks
+
+    def finish(self):
+        """ the remaining messages once the stream has ended """
+        chunks = self.feed('')
+        text = self._cut(self._length)
+        if text:
+            chunks.append(text)
+        return chunks
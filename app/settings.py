@@ -5,12 +5,152 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
 REDIS_URL = os.getenv('REDIS_URL')
 SQLALCHEMY_DATABASE_URL = os.getenv('SQLALCHEMY_DATABASE_URL')
+# the same database through asyncpg (db.py sets the driver), for db.unit_of_work
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL') or SQLALCHEMY_DATABASE_URL
 
 WECHAT_ADMIN_APPID = os.getenv('WECHAT_ADMIN_APPID')
 WECHAT_ADMIN_SECRET = os.getenv('WECHAT_ADMIN_SECRET')
 WECHAT_BOT_TOKEN = os.getenv('WECHAT_BOT_TOKEN')
+WECHAT_API_BASE_URL = os.getenv('WECHAT_API_BASE_URL', 'https://api.weixin.qq.com/cgi-bin')
+# only needed when the account uses encrypted message mode, see wechat_codec.py
+WECHAT_ENCODING_AES_KEY = os.getenv('WECHAT_ENCODING_AES_KEY')
 
 VOICE_AI_USER_ID = os.getenv('VOICE_AI_USER_ID')
 VOICE_AI_API_KEY = os.getenv('VOICE_AI_API_KEY')
 
-REDIS_KEY_PREFIX = ENV + '_'
\ No newline at end of file
+# point these (and WECHAT_API_BASE_URL) at loadtest/fake_services.py to run without the real APIs
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')
+PLAYHT_API_BASE_URL = os.getenv('PLAYHT_API_BASE_URL', 'https://play.ht/api/v1')
+
+REDIS_KEY_PREFIX = ENV + '_'
+
+# shared outbound HTTP client, see http_client.py
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS', 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 60))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 15))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP2_ENABLED = os.getenv('HTTP2_ENABLED', 'true') == 'true'
+
+# async worker stage for inbound messages, see pipeline.py and work_queue.py
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', 8))
+# run a worker inside the web process, turn off when running worker.py separately
+PIPELINE_EMBEDDED_WORKER = os.getenv('PIPELINE_EMBEDDED_WORKER', 'true') == 'true'
+WORK_QUEUE_MAXLEN = int(os.getenv('WORK_QUEUE_MAXLEN', 100000))
+WORK_QUEUE_BLOCK_MS = int(os.getenv('WORK_QUEUE_BLOCK_MS', 5000))
+WORK_QUEUE_MAX_ATTEMPTS = int(os.getenv('WORK_QUEUE_MAX_ATTEMPTS', 3))
+WORK_QUEUE_RETRY_BASE = float(os.getenv('WORK_QUEUE_RETRY_BASE', 2))
+WORK_QUEUE_RETRY_MAX = float(os.getenv('WORK_QUEUE_RETRY_MAX', 60))
+WORK_QUEUE_VISIBILITY_TIMEOUT = float(os.getenv('WORK_QUEUE_VISIBILITY_TIMEOUT', 600))
+# a job running longer is failed, so it is never reclaimed while still running
+WORK_QUEUE_JOB_TIMEOUT = float(os.getenv('WORK_QUEUE_JOB_TIMEOUT', WORK_QUEUE_VISIBILITY_TIMEOUT * 0.9))
+WORK_QUEUE_SHUTDOWN_TIMEOUT = float(os.getenv('WORK_QUEUE_SHUTDOWN_TIMEOUT', 30))
+
+# how long a WeChat MsgId is remembered for dropping webhook retries, see dedup.py
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', 300))
+
+# in-process username -> user id cache, see db.UserIdCache
+USER_ID_CACHE_SIZE = int(os.getenv('USER_ID_CACHE_SIZE', 10000))
+USER_ID_CACHE_TTL = float(os.getenv('USER_ID_CACHE_TTL', 3600))
+
+# write-behind logging of the messages table, see db.MessageWriter
+MESSAGE_LOG_BATCH_SIZE = int(os.getenv('MESSAGE_LOG_BATCH_SIZE', 50))
+MESSAGE_LOG_FLUSH_INTERVAL = float(os.getenv('MESSAGE_LOG_FLUSH_INTERVAL', 1))
+MESSAGE_LOG_MAX_PENDING = int(os.getenv('MESSAGE_LOG_MAX_PENDING', 1000))
+# connection pools of the sync and async engines, each process gets its own.
+# Connections are recycled instead of pinged on every checkout
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'false') == 'true'
+ASYNC_DB_POOL_SIZE = int(os.getenv('ASYNC_DB_POOL_SIZE', 10))
+ASYNC_DB_MAX_OVERFLOW = int(os.getenv('ASYNC_DB_MAX_OVERFLOW', 5))
+# monthly partitions of the messages table created ahead of time, see db.partition_messages
+MESSAGE_PARTITION_MONTHS_AHEAD = int(os.getenv('MESSAGE_PARTITION_MONTHS_AHEAD', 2))
+# how often the workers check that the upcoming partitions exist
+MESSAGE_PARTITION_INTERVAL = float(os.getenv('MESSAGE_PARTITION_INTERVAL', 3600))
+
+# cache of LLM answers to first questions of a conversation, see response_cache.py
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true') == 'true'
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 60*60*24*7))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 5000))
+# near-duplicate lookup on character trigrams, off by default
+RESPONSE_CACHE_SIMILARITY = os.getenv('RESPONSE_CACHE_SIMILARITY', 'false') == 'true'
+RESPONSE_CACHE_SIMILARITY_THRESHOLD = float(os.getenv('RESPONSE_CACHE_SIMILARITY_THRESHOLD', 0.85))
+
+# synthesized speech cache, see audio_cache.py
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', '/tmp/wechatbot_audio')
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+# wechat keeps uploaded temporary media for 3 days
+WECHAT_MEDIA_TTL = int(os.getenv('WECHAT_MEDIA_TTL', 60*60*24*3 - 60*60))
+
+# play.ht job completion, see tts_jobs.py
+# public url of the /tts/callback endpoint, polling only when not set
+TTS_CALLBACK_URL = os.getenv('TTS_CALLBACK_URL')
+TTS_CALLBACK_TOKEN = os.getenv('TTS_CALLBACK_TOKEN')
+TTS_POLL_INITIAL = float(os.getenv('TTS_POLL_INITIAL', 0.25))
+TTS_POLL_MAX = float(os.getenv('TTS_POLL_MAX', 4))
+TTS_TIMEOUT = float(os.getenv('TTS_TIMEOUT', 90))
+
+# long-lived LLM clients, see llm.py
+OPENAI_POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', 20))
+
+# splitting of streamed replies into wechat messages, see segmenter.py
+STREAM_MIN_CHARS = int(os.getenv('STREAM_MIN_CHARS', 20))
+# customer service text messages are limited to 2048 bytes, about 680 chinese characters
+STREAM_MAX_CHARS = int(os.getenv('STREAM_MAX_CHARS', 600))
+STREAM_FIRST_FLUSH_SECONDS = float(os.getenv('STREAM_FIRST_FLUSH_SECONDS', 1.5))
+
+# voice replies are sent per segment, see voice_stream.py. At about 4 chinese
+# characters a second 180 characters stays well under the 60 second voice limit
+VOICE_SEGMENT_MIN_CHARS = int(os.getenv('VOICE_SEGMENT_MIN_CHARS', 10))
+VOICE_SEGMENT_MAX_CHARS = int(os.getenv('VOICE_SEGMENT_MAX_CHARS', 180))
+VOICE_SYNTHESIS_CONCURRENCY = int(os.getenv('VOICE_SYNTHESIS_CONCURRENCY', 3))
+
+# inbound voice messages, see voice_ingest.py
+TRANSCRIBE_WORKERS = int(os.getenv('TRANSCRIBE_WORKERS', 4))
+VOICE_PREFETCH_TTL = int(os.getenv('VOICE_PREFETCH_TTL', 300))
+
+# process pool for the ffmpeg transcodes, see cpu_pool.py
+CPU_POOL_WORKERS = int(os.getenv('CPU_POOL_WORKERS', 2))
+CPU_POOL_MAX_PENDING = int(os.getenv('CPU_POOL_MAX_PENDING', 16))
+CPU_POOL_QUEUE_TIMEOUT = float(os.getenv('CPU_POOL_QUEUE_TIMEOUT', 30))
+
+# ordered delivery of streamed messages, see outbox.py
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 4))
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', 0.5))
+# sender threads shared by all users
+OUTBOX_SENDERS = int(os.getenv('OUTBOX_SENDERS', 8))
+OUTBOX_WAIT_TIMEOUT = float(os.getenv('OUTBOX_WAIT_TIMEOUT', 60))
+
+# access token handling, see token_manager.py
+# in prod a central server pushes tokens to /token, only dev asks WeChat directly
+WECHAT_TOKEN_SELF_REFRESH = os.getenv('WECHAT_TOKEN_SELF_REFRESH', 'true' if ENV == 'dev' else 'false') == 'true'
+WECHAT_TOKEN_REFRESH_MARGIN = int(os.getenv('WECHAT_TOKEN_REFRESH_MARGIN', 300))
+
+# one reply at a time per user, see user_turns.py
+USER_TURN_LOCK_TTL = int(os.getenv('USER_TURN_LOCK_TTL', 60))
+USER_TURN_PENDING_TTL = int(os.getenv('USER_TURN_PENDING_TTL', 60*60))
+
+# outbound rate limits shared by all processes, see rate_limit.py
+WECHAT_RATE_LIMIT_PER_MINUTE = int(os.getenv('WECHAT_RATE_LIMIT_PER_MINUTE', 600))
+OPENAI_RATE_LIMIT_PER_MINUTE = int(os.getenv('OPENAI_RATE_LIMIT_PER_MINUTE', 200))
+# share of each bucket that background work (voice) cannot use
+RATE_LIMIT_BACKGROUND_RESERVE = float(os.getenv('RATE_LIMIT_BACKGROUND_RESERVE', 0.2))
+# how long a request may queue for a token before it is shed
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', 20))
+
+# conversation history sent with each prompt, see history.py
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', 1000))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv('HISTORY_SUMMARY_MAX_TOKENS', 256))
+# a returning user whose redis history expired gets the last messages back from postgres
+HISTORY_REHYDRATE_ROWS = int(os.getenv('HISTORY_REHYDRATE_ROWS', 30))
+HISTORY_REHYDRATE_DAYS = int(os.getenv('HISTORY_REHYDRATE_DAYS', 7))
+
+# required by the /admin endpoints in the X-Admin-Key header, they are disabled when unset
+ADMIN_API_KEY = os.getenv('ADMIN_API_KEY')
+
+# metrics, see metrics.py. Set PROMETHEUS_MULTIPROC_DIR when running several uvicorn workers
+TRACE_SPANS = os.getenv('TRACE_SPANS', 'false') == 'true'
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', 0))
@@ -0,0 +1,137 @@
+"""
+WeChat access token management.
+
+The token is kept in redis for all nodes (pushed to /token by the central
+server in prod, or fetched from WeChat directly when WECHAT_TOKEN_SELF_REFRESH
+is on) and cached in process together with its expiry, so outbound calls do
+not read redis every time. A token is refreshed WECHAT_TOKEN_REFRESH_MARGIN
+seconds before it expires. Within a process only one thread refreshes at a
+time, and a redis lock makes sure only one node asks WeChat for a new token,
+since every new token invalidates the previous one.
+
+invalidate() is called when WeChat rejects a token (errcode 40001/40014/42001),
+see wechat.api_request which retries the call once with a fresh token.
+"""
+import threading
+import time
+import uuid
+import settings
+import http_client
+from starlette.concurrency import run_in_threadpool
+from db import cache
+
+TOKEN_CACHE_KEY = settings.WECHAT_ADMIN_APPID + '_access_token'
+LOCK_KEY = TOKEN_CACHE_KEY + ':lock'
+LOCK_TIMEOUT = 10
+
+# invalid credential, invalid access_token, access_token expired
+TOKEN_ERRORS = (40001, 40014, 42001)
+
+# deletes the key only if it still holds the given value
+_COMPARE_AND_DELETE = cache.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+class TokenUnavailable(Exception):
+    pass
+
+
+class TokenManager:
+
+    def __init__(self, self_refresh=None):
+        self.self_refresh = settings.WECHAT_TOKEN_SELF_REFRESH if self_refresh is None else self_refresh
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def _valid(self):
+        return self._token and time.monotonic() < self._expires_at - settings.WECHAT_TOKEN_REFRESH_MARGIN
+
+    def get(self):
+        if self._valid():
+            return self._token
+        with self._lock:
+            if not self._valid():
+                self._load()
+            return self._token
+
+    async def get_async(self):
+        if self._valid():
+            return self._token
+        return await run_in_threadpool(self.get)
+
+    def set(self, token, expires_in):
+        """ stores a token obtained elsewhere, e.g. pushed by the central server """
+        cache.set(TOKEN_CACHE_KEY, token, ex=expires_in)
+        self._remember(token, expires_in)
+
+    def invalidate(self, token):
+        """ WeChat rejected the token, make sure the next get() does not return it """
+        with self._lock:
+            if self._token == token:
+                self._token = None
+                self._expires_at = 0
+        _COMPARE_AND_DELETE(keys=[TOKEN_CACHE_KEY], args=[token])
+
+    def _remember(self, token, expires_in):
+        self._token = token
+        self._expires_at = time.monotonic() + expires_in
+
+    def _load(self):
+        pipe = cache.pipeline(transaction=False)
+        pipe.get(TOKEN_CACHE_KEY)
+        pipe.ttl(TOKEN_CACHE_KEY)
+        token, ttl = pipe.execute()
+        if token and ttl == -1:
+            # stored without an expiry, assume WeChat's default lifetime
+            ttl = 7200
+
+        if token and ttl > settings.WECHAT_TOKEN_REFRESH_MARGIN:
+            self._remember(token, ttl)
+        elif self.self_refresh:
+            self._refresh(token)
+        elif token:
+            # the central server will push a new one, use this one until then
+            self._remember(token, settings.WECHAT_TOKEN_REFRESH_MARGIN + min(max(ttl, 0), 30))
+        else:
+            raise TokenUnavailable('no WeChat access token in redis')
+
+    def _refresh(self, old_token):
+        lock_id = str(uuid.uuid4())
+        if cache.set(LOCK_KEY, lock_id, nx=True, ex=LOCK_TIMEOUT):
+            try:
+                token, expires_in = fetch_token()
+                cache.set(TOKEN_CACHE_KEY, token, ex=expires_in)
+                self._remember(token, expires_in)
+                return
+            finally:
+                _COMPARE_AND_DELETE(keys=[LOCK_KEY], args=[lock_id])
+
+        # another node is refreshing, wait for its token to show up
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(0.1)
+            token = cache.get(TOKEN_CACHE_KEY)
+            if token and token != old_token:
+                self._remember(token, max(cache.ttl(TOKEN_CACHE_KEY), 0))
+                return
+        raise TokenUnavailable('timed out waiting for another node to refresh the token')
+
+
+def fetch_token():
+    """ IMPORTANT: This will fail if the server is not IP whitelisted """
+    response = http_client.get_client().get(settings.WECHAT_API_BASE_URL + '/token', params={
+        'grant_type': 'client_credential',
+        'appid': settings.WECHAT_ADMIN_APPID,
+        'secret': settings.WECHAT_ADMIN_SECRET,
+    }).json()
+    if 'access_token' not in response:
+        raise TokenUnavailable('token request failed: %s' % response)
+    return response['access_token'], response.get('expires_in', 7200)
+
+
+tokens = TokenManager()
@@ -0,0 +1,41 @@
+"""
+In-memory audio transcoding. Audio bytes are piped through ffmpeg's
+stdin/stdout instead of being written to the working directory, so there is
+no disk I/O and no filename collisions between users.
+
+The functions are blocking and meant to be run through cpu_pool.
+"""
+import subprocess
+import ffmpeg
+
+# whisper and wechat voice messages are both limited to 60 seconds
+MAX_VOICE_SECONDS = 59
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def _command(input_format, output_format, **output_args):
+    stream = ffmpeg.input('pipe:', format=input_format)
+    stream = ffmpeg.output(stream, 'pipe:', format=output_format, **output_args)
+    return ffmpeg.compile(stream.global_args('-hide_banner', '-loglevel', 'error'))
+
+
+def transcode(data, input_format, output_format, **output_args):
+    process = subprocess.run(
+        _command(input_format, output_format, **output_args),
+        input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if process.returncode != 0:
+        raise TranscodeError(process.stderr.decode('utf-8', 'replace'))
+    return process.stdout
+
+
+def amr_to_mp3(data):
+    return transcode(data, 'amr', 'mp3')
+
+
+def trim_mp3(data, seconds=MAX_VOICE_SECONDS):
+    """ cuts an mp3 to the given length without re-encoding it """
+    return transcode(data, 'mp3', 'mp3', t=seconds, acodec='copy')
@@ -0,0 +1,101 @@
+"""
+Completion tracking for play.ht synthesis jobs.
+
+When TTS_CALLBACK_URL is configured play.ht reports finished jobs to the
+/tts/callback endpoint, authenticated by TTS_CALLBACK_TOKEN (required then). The result is stored in redis (the callback may land on
+another node) and wakes up any waiter in this process straight away. Waiters
+otherwise poll articleStatus with exponential backoff until TTS_TIMEOUT, so a
+missed callback only costs latency. Waiting is done as asyncio tasks so many
+jobs can be in progress without holding a thread each.
+"""
+import asyncio
+import json
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import settings
+import http_client
+from starlette.concurrency import run_in_threadpool
+from db import cache
+
+STATUS_URL = settings.PLAYHT_API_BASE_URL + '/articleStatus'
+RESULT_KEY_PREFIX = settings.REDIS_KEY_PREFIX + 'tts_done:'
+
+_waiters = {}
+
+
+class SynthesisTimeout(Exception):
+    pass
+
+
+class SynthesisError(Exception):
+    """ play.ht did not accept the job """
+
+
+def check_settings():
+    """ the callback endpoint trusts what it is sent, so it has to be authenticated """
+    if settings.TTS_CALLBACK_URL and not settings.TTS_CALLBACK_TOKEN:
+        raise RuntimeError('TTS_CALLBACK_URL is set without TTS_CALLBACK_TOKEN')
+
+
+def callback_url():
+    """ TTS_CALLBACK_URL with the token /tts/callback checks, None when callbacks are off """
+    if not settings.TTS_CALLBACK_URL:
+        return None
+    parts = urlsplit(settings.TTS_CALLBACK_URL)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k != 'token']
+    query.append(('token', settings.TTS_CALLBACK_TOKEN))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def _headers():
+    return {
+        'accept': 'application/json',
+        'AUTHORIZATION': settings.VOICE_AI_API_KEY,
+        'X-USER-ID': settings.VOICE_AI_USER_ID,
+    }
+
+
+async def complete(status):
+    """ records a finished job reported by the play.ht callback """
+    transcription_id = status.get('transcriptionId') or status.get('id')
+    if not transcription_id or not status.get('converted'):
+        return False
+    await run_in_threadpool(cache.set, RESULT_KEY_PREFIX + transcription_id, json.dumps(status), ex=600)
+    future = _waiters.get(transcription_id)
+    if future is not None and not future.done():
+        future.set_result(status)
+    return True
+
+
+async def _check(transcription_id):
+    result = await run_in_threadpool(cache.get, RESULT_KEY_PREFIX + transcription_id)
+    if result:
+        return json.loads(result)
+    response = await http_client.get_async_client().get(
+        STATUS_URL, params={'transcriptionId': transcription_id}, headers=_headers()
+    )
+    status = response.json()
+    if status.get('converted'):
+        return status
+    return None
+
+
+async def wait(transcription_id, timeout=None):
+    """ returns the articleStatus of the finished job (audioUrl, audioDuration, ...) """
+    loop = asyncio.get_running_loop()
+    future = _waiters.setdefault(transcription_id, loop.create_future())
+    deadline = loop.time() + (timeout or settings.TTS_TIMEOUT)
+    delay = settings.TTS_POLL_INITIAL
+    try:
+        while True:
+            status = await _check(transcription_id)
+            if status:
+                return status
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise SynthesisTimeout(transcription_id)
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), min(delay, remaining))
+            except asyncio.TimeoutError:
+                delay = min(delay * 2, settings.TTS_POLL_MAX)
+    finally:
+        _waiters.pop(transcription_id, None)
@@ -0,0 +1,118 @@
+"""
+Per-user serialization of LLM replies.
+
+Incoming messages are pushed onto a per-user pending list in redis and the
+worker that holds the user's turn lock answers them. Messages that arrive
+while a reply is being generated are left on the list for the lock holder,
+which answers all of them with one combined prompt once it is done, instead of
+starting parallel LLM calls that race on the same conversation history.
+
+The lock is only released when the pending list is empty (checked atomically),
+so a message pushed just before release cannot be left unanswered.
+"""
+import asyncio
+import uuid
+import settings
+from starlette.concurrency import run_in_threadpool
+from db import cache
+
+PENDING_PREFIX = settings.REDIS_KEY_PREFIX + 'pending:'
+LOCK_PREFIX = settings.REDIS_KEY_PREFIX + 'turn_lock:'
+
+# 1: released, 0: more messages are pending, -1: the lock was lost
+_RELEASE_SCRIPT = cache.register_script("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return -1
+end
+if redis.call('LLEN', KEYS[2]) > 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+return 1
+""")
+
+_EXTEND_SCRIPT = cache.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+_FORCE_RELEASE_SCRIPT = cache.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def push(username, message):
+    pipe = cache.pipeline()
+    pipe.rpush(PENDING_PREFIX + username, message)
+    pipe.expire(PENDING_PREFIX + username, settings.USER_TURN_PENDING_TTL)
+    pipe.execute()
+
+
+def requeue(username, message):
+    """ puts a drained message back at the front of the pending list, for a retry """
+    pipe = cache.pipeline()
+    pipe.lpush(PENDING_PREFIX + username, message)
+    pipe.expire(PENDING_PREFIX + username, settings.USER_TURN_PENDING_TTL)
+    pipe.execute()
+
+
+def drain(username):
+    """ atomically takes every pending message """
+    pipe = cache.pipeline()
+    pipe.lrange(PENDING_PREFIX + username, 0, -1)
+    pipe.delete(PENDING_PREFIX + username)
+    messages, _ = pipe.execute()
+    return messages
+
+
+def acquire(username, token):
+    return bool(cache.set(LOCK_PREFIX + username, token, nx=True, ex=settings.USER_TURN_LOCK_TTL))
+
+
+def release(username, token):
+    keys = [LOCK_PREFIX + username, PENDING_PREFIX + username]
+    return _RELEASE_SCRIPT(keys=keys, args=[token])
+
+
+def extend(username, token):
+    return _EXTEND_SCRIPT(keys=[LOCK_PREFIX + username], args=[token, settings.USER_TURN_LOCK_TTL])
+
+
+def force_release(username, token):
+    return _FORCE_RELEASE_SCRIPT(keys=[LOCK_PREFIX + username], args=[token])
+
+
+async def _keep_alive(username, token):
+    while True:
+        await asyncio.sleep(settings.USER_TURN_LOCK_TTL / 3)
+        await run_in_threadpool(extend, username, token)
+
+
+async def take_turns(username, respond):
+    """
+    answers the user's pending messages if nobody else is, respond is a
+    coroutine function taking the combined message text
+    """
+    token = str(uuid.uuid4())
+    if not await run_in_threadpool(acquire, username, token):
+        # the current lock holder will pick up our message
+        return False
+
+    keep_alive = asyncio.create_task(_keep_alive(username, token))
+    try:
+        while True:
+            messages = await run_in_threadpool(drain, username)
+            if messages:
+                await respond('\n'.join(messages))
+            if await run_in_threadpool(release, username, token) != 0:
+                return True
+    except BaseException:
+        await run_in_threadpool(force_release, username, token)
+        raise
+    finally:
+        keep_alive.cancel()
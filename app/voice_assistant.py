@@ -1,15 +1,18 @@
-import os
-import requests
+import io
+import asyncio
 import settings
-import time
+import metrics
 import re
-import ffmpeg
 import openai
-import wechat
-from pydub import AudioSegment
+import audio_cache
+import http_client
+import tts_jobs
+import transcode
+import cpu_pool
 from hanziconv import HanziConv
 
 openai.api_key = settings.OPENAI_API_KEY
+openai.api_base = settings.OPENAI_API_BASE
 
 # play.ht voice models for chinese
 MODELS = [
@@ -28,15 +31,28 @@ MODELS = [
 
 CHINESE_MODEL = 'zh-CN-XiaomoNeural'
 
-CONVERSION_URL = 'https://play.ht/api/v1/convert'
+ENGLISH_WORD = re.compile(r'\b[A-Za-z\-]+\b')
+ENGLISH_SECTION = re.compile(r'\b[A-Za-z\s.,;!?\-]+\b')
 
-def text_to_speech(message, model=CHINESE_MODEL):
+CONVERSION_URL = settings.PLAYHT_API_BASE_URL + '/convert'
+
+def audio_key(message, model=CHINESE_MODEL):
+    return audio_cache.audio_key(prepare_text(message), model)
+
+async def text_to_speech(message, model=CHINESE_MODEL):
+    """ returns the path of an mp3 of the message, the file belongs to audio_cache and must not be removed """
     message = prepare_text(message)
+    key = audio_cache.audio_key(message, model)
+    cached_file = audio_cache.get(key)
+    if cached_file:
+        return cached_file
 
     payload = {
         'content': [message],
         'voice': model
     }
+    if settings.TTS_CALLBACK_URL:
+        payload['callbackUrl'] = tts_jobs.callback_url()
 
     headers = {
         "accept": "application/json",
@@ -45,46 +61,23 @@ def text_to_speech(message, model=CHINESE_MODEL):
         "X-USER-ID": settings.VOICE_AI_USER_ID
     }
 
-    response = requests.post(CONVERSION_URL, json=payload, headers=headers)
-
-    transcription_id = response.json().get('transcriptionId')
-
-    # poll for job success, eventually migrate this to webhook
-
-    job_done = False
-    url = f"https://play.ht/api/v1/articleStatus?transcriptionId={transcription_id}"
-
-    headers = {
-        "accept": "application/json",
-        "AUTHORIZATION": settings.VOICE_AI_API_KEY,
-        "X-USER-ID": settings.VOICE_AI_USER_ID
-    }
-
-    while not job_done:
-        response = requests.get(url, headers=headers)
-        if response.json().get('converted'):
-            job_done = True
-            audio_file = response.json().get('audioUrl')
-            audio_duration = response.json().get('audioDuration')
-        else:
-            time.sleep(2)
-
-    response = requests.get(audio_file)
+    client = http_client.get_async_client()
+    with metrics.span('tts_synthesis', chars=len(message)):
+        response = await client.post(CONVERSION_URL, json=payload, headers=headers)
+        transcription_id = response.json().get('transcriptionId')
+        if not transcription_id:
+            raise tts_jobs.SynthesisError('no transcriptionId in play.ht response %s: %s' % (response.status_code, response.text[:200]))
 
-    filename = transcription_id + '.mp3'
-    with open(filename, 'wb') as f:
-        f.write(response.content)
+        with metrics.span('tts_polling', transcription_id=transcription_id):
+            status = await tts_jobs.wait(transcription_id)
+        response = await client.get(status.get('audioUrl'))
+        audio = response.content
 
-    if audio_duration > 60:
-        trimmed_filename = transcription_id.replace('-', '') + '_trimmed.mp3'
-        stream = ffmpeg.input(filename)
-        stream = ffmpeg.output(stream, trimmed_filename, t=59)
-        stream = ffmpeg.overwrite_output(stream)
-        ffmpeg.run(stream)
-        os.remove(filename)
-        return trimmed_filename
+    if status.get('audioDuration', 0) > 60:
+        print('synthesized audio is %ss long, trimming' % status.get('audioDuration'))
+        audio = await cpu_pool.run(transcode.trim_mp3, audio)
 
-    return filename
+    return audio_cache.put(key, audio)
 
 
 def has_english(text):
@@ -92,49 +85,25 @@ def has_english(text):
     Will return True or False depending on if the text contains more than 8 english words. 
     Use this condition to determine if it is necessary to convert the text to speech  
     """
-    english_words = re.findall(r'\b[A-Za-z\-]+\b', text)
+    english_words = ENGLISH_WORD.findall(text)
     return len(english_words) > 8
 
 def prepare_text(text):
-    english_sections = re.findall(r'\b[A-Za-z\s.,;!?\-]+\b', text)
-    for section in english_sections:
-        text = text.replace(section, f',{section},', 1)
-    return text
+    """ sets english sections off with commas so the chinese voice pauses around them """
+    # one pass over the text, cheap enough that it is not worth sending to cpu_pool
+    return ENGLISH_SECTION.sub(r',\g<0>,', text)
 
 def test():
     s = '你可以学习这个短语 "self-care"（自我关怀）来描述一个人照顾自己身心健康的行为和习惯。例如，你可以说 "Practicing self-care is important for maintaining a healthy lifestyle."（实施自我关怀对于保持健康的生活方式很重要）。这个短语可以帮助你学习如何照顾自己的身心健康，与"laughter is the best medicine" 相关。你可以学习这个短语 "self-care"（自我关怀）来描述一个人照顾自己身心健康的行为和习惯。例如，你可以说 "Practicing self-care is important for maintaining a healthy lifestyle."（实施自我关怀对于保持健康的生活方式很重要）。这个短语可以帮助你学习如何照顾自己的身心健康，与"laughter is the best medicine" 相关。你可以学习这个短语 "self-care"（自我关怀）来描述一个人照顾自己身心健康的行为和习惯。例如，你可以说 "Practicing self-care is important for maintaining a healthy lifestyle."（实施自我关怀对于保持健康的生活方式很重要）。这个短语可以帮助你学习如何照顾自己的身心健康，与"laughter is the best medicine" 相关。'
-    return text_to_speech(s)
-
-
-def get_voice_message(media_id):
-    file_id = str(media_id).replace('-', '')
-    file_id = 'sample'
-    access_token = wechat.get_access_token()
-    url = f'https://api.weixin.qq.com/cgi-bin/media/get?access_token={access_token}&media_id={media_id}'
-    response = requests.get(url)
-    amr_in = file_id + '.amr'
-    mp3_out = file_id + '.mp3'
-    with open(amr_in, 'wb') as f:
-        f.write(response.content)
-
-    amr_audio = AudioSegment.from_file(amr_in, format='amr')
-    mp3_audio = amr_audio.export(mp3_out, format='mp3')
-    transcript = openai.Audio.transcribe('whisper-1', mp3_audio)
-    text = transcript.get('text')
-    return text
-
+    return asyncio.run(text_to_speech(s))
 
-def transcribe_audio(amr_in):
-    file_id = os.path.basename(amr_in).replace('.amr', '')
-    mp3_out = file_id + '.mp3'
 
-    amr_audio = AudioSegment.from_file(amr_in, format='amr')
-    mp3_audio = amr_audio.export(mp3_out, format='mp3')
-    transcript = openai.Audio.transcribe('whisper-1', mp3_audio)
+def transcribe_audio(amr_audio):
+    """ amr_audio: the bytes of a wechat voice message """
+    mp3_audio = io.BytesIO(cpu_pool.call(transcode.amr_to_mp3, amr_audio))
+    # the openai client takes the upload filename (and so the format) from .name
+    mp3_audio.name = 'voice.mp3'
+    with metrics.span('whisper_transcription', bytes=len(amr_audio)):
+        transcript = openai.Audio.transcribe('whisper-1', mp3_audio)
     text = transcript.get('text')
-    os.remove(amr_in)
-    os.remove(mp3_out)
     return text
-
-
-
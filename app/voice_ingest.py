@@ -0,0 +1,91 @@
+"""
+Ingest of inbound voice messages.
+
+The webhook calls prefetch() for a voice message as soon as it is accepted,
+which starts downloading the audio from WeChat while the job waits in the
+queue. The audio is kept in redis for a few minutes, since the job may be
+picked up by a worker in another process. When WeChat's own speech
+recognition is enabled the message carries a Recognition field and none of
+this is needed, see pipeline.handle_message.
+
+Transcriptions run on a pool of TRANSCRIBE_WORKERS threads per process, so a
+burst of voice messages cannot take all the threads of the default threadpool.
+The transcript is written back onto the logged message row.
+"""
+import asyncio
+import base64
+import traceback
+import settings
+import metrics
+import db
+import wechat
+import voice_assistant
+from concurrent.futures import ThreadPoolExecutor
+from starlette.concurrency import run_in_threadpool
+from db import cache
+
+AUDIO_KEY_PREFIX = settings.REDIS_KEY_PREFIX + 'voice_in:'
+
+_pool = ThreadPoolExecutor(max_workers=settings.TRANSCRIBE_WORKERS, thread_name_prefix='transcribe')
+_downloads = {}
+
+
+class VoiceDownloadError(Exception):
+    pass
+
+
+def prefetch(media_id):
+    """ starts downloading the audio in the background, call from the event loop """
+    if media_id in _downloads:
+        return
+    task = asyncio.create_task(_download(media_id))
+    _downloads[media_id] = task
+    task.add_done_callback(lambda _: _downloads.pop(media_id, None))
+    task.add_done_callback(_report_failure)
+
+
+def _report_failure(task):
+    # fetch_audio downloads again, so a failed prefetch only costs time
+    if not task.cancelled() and task.exception() is not None:
+        print('voice prefetch failed', task.exception())
+
+
+async def _download(media_id):
+    with metrics.span('wechat_media_download'):
+        response = await wechat.api_request_async('GET', '/media/get', params={'media_id': media_id})
+    # errors come back as json instead of audio
+    if response.status_code != 200 or response.content.startswith(b'{'):
+        raise VoiceDownloadError('%s: %s' % (media_id, response.text[:200]))
+    audio = response.content
+    await run_in_threadpool(cache.set, AUDIO_KEY_PREFIX + media_id, base64.b64encode(audio), ex=settings.VOICE_PREFETCH_TTL)
+    return audio
+
+
+async def fetch_audio(media_id):
+    """ the AMR audio of a voice message, from the prefetch if there was one """
+    task = _downloads.get(media_id)
+    if task is not None:
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            traceback.print_exc()
+    else:
+        cached = await run_in_threadpool(cache.get, AUDIO_KEY_PREFIX + media_id)
+        if cached:
+            return base64.b64decode(cached)
+    return await _download(media_id)
+
+
+async def transcribe(media_id):
+    """ returns the transcript of a voice message and records it on the logged message """
+    audio = await fetch_audio(media_id)
+    loop = asyncio.get_running_loop()
+    text = await loop.run_in_executor(_pool, voice_assistant.transcribe_audio, audio)
+    await run_in_threadpool(_record, media_id, text)
+    return text
+
+
+def _record(media_id, text):
+    cache.delete(AUDIO_KEY_PREFIX + media_id)
+    if text:
+        db.message_writer.set_content(media_id, text)
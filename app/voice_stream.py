@@ -0,0 +1,86 @@
+"""
+Pipelined voice replies.
+
+Instead of synthesizing the whole answer once the LLM is done, the streamed
+answer is split into segments of a few sentences (short enough to stay under
+WeChat's 60 second voice limit) and each segment is synthesized and uploaded
+as soon as it is complete, up to VOICE_SYNTHESIS_CONCURRENCY at a time. A
+single sender sends the uploaded segments in answer order, so the first voice
+message goes out while the rest of the answer is still being generated.
+
+put() and close() may be called from any thread (the LLM callbacks run in the
+threadpool), everything else runs on the event loop the stream was created on.
+"""
+import asyncio
+import traceback
+import settings
+import metrics
+from segmenter import StreamSegmenter
+
+
+def new_segmenter():
+    """ splits an answer into voice segments, the first one at the first sentence end """
+    return StreamSegmenter(
+        min_chars=settings.VOICE_SEGMENT_MIN_CHARS,
+        max_chars=settings.VOICE_SEGMENT_MAX_CHARS,
+        first_flush_seconds=0,
+    )
+
+
+class VoiceStream:
+    """
+    chatbot: the ChatBot of the user, provides upload_voice and send_voice_media
+    """
+
+    def __init__(self, chatbot, concurrency=None):
+        self.chatbot = chatbot
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(concurrency or settings.VOICE_SYNTHESIS_CONCURRENCY)
+        self._queue = asyncio.Queue()
+        self._first_sent = False
+        self._sender = asyncio.create_task(self._send_in_order())
+
+    def __repr__(self):
+        return f'<VoiceStream for {self.chatbot.username} pending={self._queue.qsize()}>'
+
+    def put(self, segment):
+        """ queues a segment of the answer, synthesis starts straight away """
+        self._loop.call_soon_threadsafe(self._start, segment)
+
+    def close(self):
+        """ no more segments will be put """
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
+    async def wait(self):
+        """ returns once every segment has been sent or given up on """
+        await self._sender
+
+    def _start(self, segment):
+        task = asyncio.create_task(self._prepare(segment))
+        self._queue.put_nowait((segment, task))
+
+    async def _prepare(self, segment):
+        async with self._slots:
+            return await self.chatbot.upload_voice(segment)
+
+    async def _send_in_order(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            segment, task = item
+            try:
+                media_id = await task
+                if not media_id:
+                    print('voice segment was not uploaded for', self.chatbot.username)
+                    metrics.ERRORS.labels('voice_segment').inc()
+                    continue
+                await self.chatbot.send_voice_media(media_id, segment)
+            except Exception:
+                # a lost segment should not stop the rest of the answer
+                traceback.print_exc()
+                metrics.ERRORS.labels('voice_segment').inc()
+                continue
+            if not self._first_sent:
+                self._first_sent = True
+                metrics.since('time_to_first_audio', self.chatbot.received_at)
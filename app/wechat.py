@@ -1,28 +1,69 @@
-import requests
+import anyio
 import json
-import time
 import os
 import settings
 import voice_assistant
 import db
+import http_client
+import audio_cache
+import outbox
+import token_manager
+import rate_limit
+import metrics
+import wechat_codec
 from db import cache
 from fastapi import Response
-from pydub import AudioSegment
+from starlette.concurrency import run_in_threadpool
 
 APP_ID = settings.WECHAT_ADMIN_APPID
 APP_SECRET = settings.WECHAT_ADMIN_SECRET
-TOKEN_CACHE_KEY = settings.WECHAT_ADMIN_APPID + '_access_token'
-
-def _refresh_token():
-    """ IMPORTANT: This will fail if the server is not IP whitelisted """
-    s = requests.Session()
-    response = s.get('https://api.weixin.qq.com/cgi-bin/token', params={
-        'grant_type': 'client_credential',
-        'appid': APP_ID,
-        'secret': APP_SECRET,
-    }).json()
-    cache.set(TOKEN_CACHE_KEY, response['access_token'], ex=60*60*1)
-    return response['access_token']
+TOKEN_CACHE_KEY = token_manager.TOKEN_CACHE_KEY
+
+API_BASE_URL = settings.WECHAT_API_BASE_URL
+JSON_HEADERS = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+
+def _encode(data):
+    return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+def _token_rejected(response):
+    # errors come back as json, even from endpoints that normally return media
+    if not response.content.startswith(b'{'):
+        return False
+    try:
+        return response.json().get('errcode') in token_manager.TOKEN_ERRORS
+    except ValueError:
+        return False
+
+def api_request(method, path, params=None, **kwargs):
+    """
+    Calls the WeChat API through the shared connection pool with the current
+    access token. If WeChat rejects the token it is refreshed and the call is retried once.
+    """
+    url = API_BASE_URL + path
+    for attempt in (1, 2):
+        access_token = token_manager.tokens.get()
+        response = http_client.get_client().request(method, url, params=dict(params or {}, access_token=access_token), **kwargs)
+        if attempt == 2 or not _token_rejected(response):
+            return response
+        metrics.RETRIES.labels('wechat_token').inc()
+        token_manager.tokens.invalidate(access_token)
+
+async def api_request_async(method, path, params=None, **kwargs):
+    url = API_BASE_URL + path
+    for attempt in (1, 2):
+        access_token = await token_manager.tokens.get_async()
+        response = await http_client.get_async_client().request(method, url, params=dict(params or {}, access_token=access_token), **kwargs)
+        if attempt == 2 or not _token_rejected(response):
+            return response
+        metrics.RETRIES.labels('wechat_token').inc()
+        await run_in_threadpool(token_manager.tokens.invalidate, access_token)
+
+def api_post(path, data):
+    """ POST a json payload to the WeChat API """
+    return api_request('POST', path, content=_encode(data), headers=JSON_HEADERS)
+
+async def api_post_async(path, data):
+    return await api_request_async('POST', path, content=_encode(data), headers=JSON_HEADERS)
 
 class ChatBot:
     def __init__(self, username, db_session=None):
@@ -30,44 +71,33 @@ class ChatBot:
         self.db_session = db_session
         self.state_cache_key = 'state:' + self.username
         self.attached_message_key = 'attached_msg:' + self.username
+        # when the webhook received the message being answered, set by the pipeline for latency metrics
+        self.received_at = None
+        self._first_chunk_sent = False
+        # replies handed to the outbox or sent, a retried job must not repeat them
+        self.replies_sent = 0
    
     def __repr__(self):
         return f'<ChatBot for {self.username}>'
     
     @property
     def access_token(self):
-        return cache.get(TOKEN_CACHE_KEY)
+        return token_manager.tokens.get()
     
     def _validate_message(self, message):
-        # Check if the message XML is valid
+        # Check if the message is a valid text message, message is a wechat_codec.WeChatMessage
         # Common Messages: http://admin.wechat.com/wiki/index.php?title=Common_Messages
         # Event Messages: http://admin.wechat.com/wiki/index.php?title=Event-based_Messages
         # Speech Recognition Messages: http://admin.wechat.com/wiki/index.php?title=Speech_Recognition_Messages
         return (
-            message != None and
-            message['xml'] != None and
-            message['xml']['MsgType'] != None and
-            message['xml']['MsgType'] == 'text' and
-            message['xml']['Content'] != None
+            message is not None and
+            message.msg_type == 'text' and
+            message.content is not None
         )
 
     def _format_message(self, original_message, content):
-         # Format the reply according to the WeChat XML format for synchronous replies,
-        # see: http://admin.wechat.com/wiki/index.php?title=Callback_Messages
-        return (
-            "<xml>"
-            "<ToUserName><![CDATA[%s]]></ToUserName>"
-            "<FromUserName><![CDATA[%s]]></FromUserName>"
-            "<CreateTime>%s</CreateTime>"
-            "<MsgType><![CDATA[text]]></MsgType>"
-            "<Content><![CDATA[%s]]></Content>"
-            "</xml>"
-        ) % (
-            original_message['xml']['FromUserName'],
-            original_message['xml']['ToUserName'],
-            time.gmtime(),
-            content
-        )
+        # Format the reply according to the WeChat XML format for synchronous replies
+        return wechat_codec.render_text_reply(original_message, content)
     
     @property
     def state(self):
@@ -87,12 +117,29 @@ class ChatBot:
     def attached_message(self, value):
         return cache.set(self.attached_message_key, value)
 
-    def receive_message(self, message=None, media_id=None, msg_type='text'):
+    def pop_attached_message(self):
+        """ reads and clears the attached message in one step """
+        return cache.getdel(self.attached_message_key)
+
+    def _log_message(self, sender, receiver, **kwargs):
+        """ sender and receiver are usernames, the row is written in the background by db.message_writer """
         with db.SessionLocal() as session:
-            bot = db.get_or_create_user(session, 'bot')
-            user = db.get_or_create_user(session, self.username)
-            message = db.log_message(session, user, bot, content=message, media_id=media_id,msg_type=msg_type, source='user')
-        return message
+            sender_id = db.get_user_id(session, sender)
+            receiver_id = db.get_user_id(session, receiver)
+        db.message_writer.log(sender_id, receiver_id, **kwargs)
+
+    async def _log_message_async(self, sender, receiver, **kwargs):
+        """ _log_message for the event loop, user lookups go through the flow's db.unit_of_work """
+        async with db.unit_of_work() as session:
+            sender_id = await db.get_user_id_async(session, sender)
+            receiver_id = await db.get_user_id_async(session, receiver)
+        db.message_writer.log_nowait(sender_id, receiver_id, **kwargs)
+
+    def receive_message(self, message=None, media_id=None, msg_type='text'):
+        self._log_message(self.username, 'bot', content=message, media_id=media_id, msg_type=msg_type)
+
+    async def receive_message_async(self, message=None, media_id=None, msg_type='text'):
+        await self._log_message_async(self.username, 'bot', content=message, media_id=media_id, msg_type=msg_type)
 
     def send_text_response(self, reply, original_message):
         """
@@ -100,87 +147,113 @@ class ChatBot:
         to_user: openid of the receiver
         
         """
-        with db.SessionLocal() as session:
-            user = db.get_or_create_user(session, self.username)
-            system = db.get_or_create_user(session, 'system')
-            resp = self._format_message(original_message, reply)
-            db.log_message(session, system, user, content=reply, msg_type='text')
-        self.state = 'listening'
+        resp = self._format_message(original_message, reply)
+        self.log_text_response(reply)
         return Response(content=resp, status_code=200)
 
-    def send_async_text_response(self, message, send_voice=False):
-        with db.SessionLocal() as session:
-            user = db.get_or_create_user(session, self.username)
-            sender = db.get_or_create_user(session, 'bot')
-
-            tries = 1
-            # TODO: handle case after 3 unsuccessful attempts
-            while tries <= 3:
-                access_token = self.access_token
-                url = 'https://api.weixin.qq.com/cgi-bin/message/custom/send?access_token=%s' % (access_token, )
-                data = {
-                    'touser': self.username,
-                    'msgtype':'text',
-                    'text':
-                    {
-                        'content': message
-                    }
-                }
-                headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-                response = requests.post(url, data=json.dumps(data, ensure_ascii=False).encode('utf-8'), headers=headers).json()
-                if response.get('errcode') == 0:
-                    break
-                else:
-                    time.sleep(2)
-                    tries += 1
+    def log_text_response(self, reply):
+        """ records a reply that was returned directly in the webhook response """
+        self._log_message('system', self.username, content=reply, msg_type='text')
+        self.state = 'listening'
 
-            db.log_message(session, sender, user, content=message, msg_type='text')
+    async def log_text_response_async(self, reply):
+        await self._log_message_async('system', self.username, content=reply, msg_type='text')
+        await run_in_threadpool(cache.set, self.state_cache_key, 'listening')
+
+    def deliver_text(self, message):
+        """ a single attempt at sending a text message, returns True if WeChat accepted it """
+        data = {
+            'touser': self.username,
+            'msgtype':'text',
+            'text':
+            {
+                'content': message
+            }
+        }
+        rate_limit.acquire('wechat')
+        response = api_post('/message/custom/send', data).json()
+        if response.get('errcode') != 0:
+            print('send failed', response)
+            return False
+        if not self._first_chunk_sent:
+            self._first_chunk_sent = True
+            metrics.since('time_to_first_chunk', self.received_at)
+        self._log_message('bot', self.username, content=message, msg_type='text')
+        return True
+
+    def queue_text_response(self, message):
+        """ non-blocking send, messages are delivered in order by the user's outbox """
+        outbox.send(self.username, self.deliver_text, message)
+        self.replies_sent += 1
+
+    def wait_for_responses(self, timeout=None):
+        return outbox.wait(self.username, timeout or settings.OUTBOX_WAIT_TIMEOUT)
+
+    def send_async_text_response(self, message, send_voice=False):
+        """ blocking send, after anything already queued for the user """
+        self.queue_text_response(message)
+        self.wait_for_responses()
 
         if send_voice:
             v_response = self.send_async_voice_response(message)
 
-        return response
-
     def send_async_voice_response(self, message):
-        audio_file = voice_assistant.text_to_speech(message)
-        access_token = self.access_token
-        upload_audio_url = f'https://api.weixin.qq.com/cgi-bin/media/upload?access_token={access_token}&type=voice'
-        with open(audio_file, 'rb') as f:
-            send_files = {'media': (audio_file, f, 'audio/mpeg')}
-            response = requests.post(upload_audio_url, files=send_files)
-        media_id = response.json().get('media_id')
-
-        url = 'https://api.weixin.qq.com/cgi-bin/message/custom/send?access_token=%s' % (access_token, )
+        """ blocking version of send_voice_response_async, for code running in the threadpool """
+        return anyio.from_thread.run(self.send_voice_response_async, message)
+
+    async def send_voice_response_async(self, message):
+        media_id = await self.upload_voice(message)
+        return await self.send_voice_media(media_id, message)
+
+    async def upload_voice(self, message):
+        """ synthesizes the message and uploads it to WeChat, returns the media_id """
+        # the same text was synthesized and uploaded recently, reuse it
+        audio_key = voice_assistant.audio_key(message)
+        media_id = audio_cache.get_media_id(audio_key)
+        if not media_id:
+            audio_file = await voice_assistant.text_to_speech(message)
+            with open(audio_file, 'rb') as f:
+                send_files = {'media': (os.path.basename(audio_file), f.read(), 'audio/mpeg')}
+            with metrics.span('wechat_upload', username=self.username):
+                response = await api_request_async('POST', '/media/upload', params={'type': 'voice'}, files=send_files)
+            media_id = response.json().get('media_id')
+            if media_id:
+                audio_cache.set_media_id(audio_key, media_id)
+        return media_id
+
+    async def send_voice_media(self, media_id, message):
+        """ sends an uploaded voice message, message is the text it was synthesized from """
         data = {
             'touser': self.username,
             'msgtype':'voice',
             'voice': {'media_id': media_id}
         }
-        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        response = requests.post(url, data=json.dumps(data, ensure_ascii=False).encode('utf-8'), headers=headers)
-        os.remove(audio_file)
+        await rate_limit.acquire_async('wechat', rate_limit.BACKGROUND)
+        response = await api_post_async('/message/custom/send', data)
+        self.replies_sent += 1
 
-        with db.SessionLocal() as session:
-            user = db.get_or_create_user(session, self.username)
-            sender = db.get_or_create_user(session, 'bot')
-            db.log_message(session, sender, user, content=message, msg_type='voice', media_id=media_id)
+        await run_in_threadpool(self._log_message, 'bot', self.username, content=message, msg_type='voice', media_id=media_id)
         return response
 
     def send_busy_status(self):
         self.state = 'busy'
-        access_token = self.access_token
-        url = 'https://api.weixin.qq.com/cgi-bin/message/custom/typing?access_token=%s' % (access_token, )
         data = {
             'touser': self.username,
             'command': 'Typing'
         }
-        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        response = requests.post(url, data=json.dumps(data, ensure_ascii=False).encode('utf-8'), headers=headers)
+        response = api_post('/message/custom/typing', data)
+        return response
+
+    async def send_busy_status_async(self):
+        await run_in_threadpool(cache.set, self.state_cache_key, 'busy')
+        data = {
+            'touser': self.username,
+            'command': 'Typing'
+        }
+        response = await api_post_async('/message/custom/typing', data)
         return response
 
     def send_menu_message(self):
-        access_token = self.access_token
-        url = 'https://api.weixin.qq.com/cgi-bin/message/custom/send?access_token=%s' % (access_token, )
         data = {
             'touser': self.username,
             'msgtype': 'msgmenu',
@@ -200,15 +273,9 @@ class ChatBot:
             }
         }
 
-        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
-        response = requests.post(url, data=json.dumps(data, ensure_ascii=False).encode('utf-8'), headers=headers)
+        response = api_post('/message/custom/send', data)
         return response
 
     def get_voice_message(self, media_id):
-        access_token = self.access_token
-        url = f'https://api.weixin.qq.com/cgi-bin/media/get?access_token={access_token}&media_id={media_id}'
-        response = requests.get(url)
-        amr_file = str(media_id) + '.amr'
-        with open(amr_file, 'wb') as f:
-            f.write(response.content)
-        return voice_assistant.transcribe_audio(amr_file)
\ No newline at end of file
+        response = api_request('GET', '/media/get', params={'media_id': media_id})
+        return voice_assistant.transcribe_audio(response.content)
\ No newline at end of file
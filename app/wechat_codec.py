@@ -0,0 +1,203 @@
+"""
+Parsing and rendering of the XML that WeChat POSTs to /wechat.
+
+parse() reads the body with ElementTree straight into a WeChatMessage, without
+building the generic nested dict xmltodict does. Replies are rendered from
+precompiled templates with CDATA-safe escaping.
+
+WeChat's encrypted mode (encrypt_type=aes) is supported by MessageCrypto:
+the body then only carries an <Encrypt> field, AES-256-CBC with the key from
+WECHAT_ENCODING_AES_KEY, signed with msg_signature. Replies have to be encrypted
+the same way.
+"""
+import base64
+import hashlib
+import os
+import struct
+import time
+from dataclasses import dataclass
+from xml.etree import ElementTree
+from Crypto.Cipher import AES
+import settings
+
+
+class MessageError(ValueError):
+    """ the body is not a valid (or correctly signed) WeChat message """
+
+
+# xml tag -> WeChatMessage attribute
+FIELDS = {
+    'ToUserName': 'to_user',
+    'FromUserName': 'from_user',
+    'CreateTime': 'create_time',
+    'MsgType': 'msg_type',
+    'Content': 'content',
+    'MediaId': 'media_id',
+    'Format': 'format',
+    'Recognition': 'recognition',
+    'MsgId': 'msg_id',
+    'Event': 'event',
+    'EventKey': 'event_key',
+}
+
+
+@dataclass
+class WeChatMessage:
+    """ the fields of an inbound message that the bot uses, None when absent """
+    __slots__ = tuple(FIELDS.values())
+
+    to_user: str
+    from_user: str
+    create_time: str
+    msg_type: str
+    content: str
+    media_id: str
+    format: str
+    recognition: str
+    msg_id: str
+    event: str
+    event_key: str
+
+    def to_dict(self):
+        """ the message with WeChat's field names, as queued for the pipeline """
+        return {tag: getattr(self, name) for tag, name in FIELDS.items() if getattr(self, name) is not None}
+
+
+def _parse_root(body):
+    # a webhook never has a DTD, refusing them rules out entity expansion attacks
+    if b'<!DOCTYPE' in body or b'<!ENTITY' in body:
+        raise MessageError('DTDs are not allowed')
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError as e:
+        raise MessageError(str(e))
+    if root.tag != 'xml':
+        raise MessageError('root element is %s' % root.tag)
+    return root
+
+
+def parse(body):
+    """ body: the raw POST body, returns a WeChatMessage """
+    root = _parse_root(body)
+    values = dict.fromkeys(FIELDS.values())
+    for element in root:
+        name = FIELDS.get(element.tag)
+        if name is not None:
+            values[name] = element.text
+    return WeChatMessage(**values)
+
+
+def parse_encrypted_field(body):
+    """ returns the Encrypt field of an encrypted mode body """
+    encrypted = _parse_root(body).findtext('Encrypt')
+    if not encrypted:
+        raise MessageError('no Encrypt field')
+    return encrypted
+
+
+def cdata(text):
+    """ wraps text in CDATA, splitting any ]]> in it so it cannot close the section early """
+    return '<![CDATA[' + str(text).replace(']]>', ']]]]><![CDATA[>') + ']]>'
+
+
+TEXT_REPLY_TEMPLATE = (
+    '<xml>'
+    '<ToUserName>{to_user}</ToUserName>'
+    '<FromUserName>{from_user}</FromUserName>'
+    '<CreateTime>{create_time}</CreateTime>'
+    '<MsgType><![CDATA[text]]></MsgType>'
+    '<Content>{content}</Content>'
+    '</xml>'
+).format
+
+ENCRYPTED_REPLY_TEMPLATE = (
+    '<xml>'
+    '<Encrypt>{encrypted}</Encrypt>'
+    '<MsgSignature>{signature}</MsgSignature>'
+    '<TimeStamp>{timestamp}</TimeStamp>'
+    '<Nonce>{nonce}</Nonce>'
+    '</xml>'
+).format
+
+
+def render_text_reply(message, content, create_time=None):
+    """ a synchronous text reply to message, see http://admin.wechat.com/wiki/index.php?title=Callback_Messages """
+    return TEXT_REPLY_TEMPLATE(
+        to_user=cdata(message.from_user),
+        from_user=cdata(message.to_user),
+        create_time=int(create_time or time.time()),
+        content=cdata(content),
+    )
+
+
+def signature(token, timestamp, nonce, encrypted=''):
+    """ sha1 of the sorted parts, used for both plain URL signatures and msg_signature """
+    parts = [token, str(timestamp), nonce]
+    if encrypted:
+        parts.append(encrypted)
+    return hashlib.sha1(''.join(sorted(parts)).encode('utf-8')).hexdigest()
+
+
+class MessageCrypto:
+    """
+    token: WECHAT_BOT_TOKEN
+    encoding_aes_key: the 43 character key from the WeChat admin console
+    app_id: the official account appid, part of every plaintext
+    """
+    BLOCK_SIZE = 32
+
+    def __init__(self, token, encoding_aes_key, app_id):
+        self.token = token
+        self.app_id = app_id
+        self.key = base64.b64decode(encoding_aes_key + '=')
+        if len(self.key) != 32:
+            raise ValueError('invalid EncodingAESKey')
+
+    def _cipher(self):
+        return AES.new(self.key, AES.MODE_CBC, self.key[:16])
+
+    def decrypt(self, encrypted, msg_signature, timestamp, nonce):
+        """ verifies msg_signature and returns the inner XML body as bytes """
+        if signature(self.token, timestamp, nonce, encrypted) != msg_signature:
+            raise MessageError('invalid msg_signature')
+        try:
+            plaintext = self._cipher().decrypt(base64.b64decode(encrypted))
+        except (ValueError, TypeError) as e:
+            raise MessageError('cannot decrypt message: %s' % e)
+        padding = plaintext[-1] if plaintext else 0
+        if not 1 <= padding <= self.BLOCK_SIZE or len(plaintext) < 20 + padding:
+            raise MessageError('invalid padding')
+        # 16 random bytes, the body length, the body, then the appid
+        plaintext = plaintext[16:-padding]
+        length = struct.unpack('>I', plaintext[:4])[0]
+        body, app_id = plaintext[4:4 + length], plaintext[4 + length:]
+        if app_id != self.app_id.encode('utf-8'):
+            raise MessageError('message is for another appid')
+        return body
+
+    def encrypt(self, body, timestamp=None, nonce=None):
+        """ wraps a rendered reply for encrypted mode """
+        timestamp = str(timestamp or int(time.time()))
+        nonce = nonce or base64.b16encode(os.urandom(5)).decode('ascii').lower()
+        data = body.encode('utf-8')
+        plaintext = os.urandom(16) + struct.pack('>I', len(data)) + data + self.app_id.encode('utf-8')
+        padding = self.BLOCK_SIZE - len(plaintext) % self.BLOCK_SIZE
+        plaintext += bytes([padding]) * padding
+        encrypted = base64.b64encode(self._cipher().encrypt(plaintext)).decode('ascii')
+        return ENCRYPTED_REPLY_TEMPLATE(
+            encrypted=cdata(encrypted),
+            signature=cdata(signature(self.token, timestamp, nonce, encrypted)),
+            timestamp=timestamp,
+            nonce=cdata(nonce),
+        )
+
+
+_crypto = None
+
+
+def get_crypto():
+    """ the MessageCrypto for the configured account, None if encrypted mode is not set up """
+    global _crypto
+    if _crypto is None and settings.WECHAT_ENCODING_AES_KEY:
+        _crypto = MessageCrypto(settings.WECHAT_BOT_TOKEN, settings.WECHAT_ENCODING_AES_KEY, settings.WECHAT_ADMIN_APPID)
+    return _crypto
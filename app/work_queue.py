@@ -0,0 +1,210 @@
+"""
+Durable work queue on top of Redis streams (the same redis as db.cache).
+
+Jobs are added to a stream and read by a consumer group, so every job is
+delivered to exactly one worker and stays pending until it is acked.
+Failed jobs are retried with exponential backoff through a delayed set and
+moved to a dead-letter stream after WORK_QUEUE_MAX_ATTEMPTS. Jobs left
+pending by a crashed worker are reclaimed after WORK_QUEUE_VISIBILITY_TIMEOUT.
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import time
+import traceback
+import redis
+import settings
+import metrics
+from starlette.concurrency import run_in_threadpool
+from db import cache
+
+STREAM_KEY = settings.REDIS_KEY_PREFIX + 'jobs'
+DELAYED_KEY = STREAM_KEY + ':delayed'
+DEAD_LETTER_KEY = STREAM_KEY + ':dead'
+GROUP = 'workers'
+
+# moves due jobs from the delayed set back onto the stream atomically,
+# so that several workers can run the maintenance loop at the same time
+_PROMOTE_SCRIPT = cache.register_script("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, job in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job)
+    local fields = cjson.decode(job)
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*',
+        'type', fields['type'], 'payload', fields['payload'], 'attempts', fields['attempts'])
+end
+return #due
+""")
+
+
+def enqueue(job_type, payload, attempts=0):
+    fields = {
+        'type': job_type,
+        'payload': json.dumps(payload, ensure_ascii=False),
+        'attempts': attempts,
+    }
+    return cache.xadd(STREAM_KEY, fields, maxlen=settings.WORK_QUEUE_MAXLEN, approximate=True)
+
+
+def ensure_group():
+    try:
+        cache.xgroup_create(STREAM_KEY, GROUP, id='0', mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def backoff(attempts):
+    """ seconds to wait before the given retry attempt, with full jitter """
+    delay = min(settings.WORK_QUEUE_RETRY_BASE * 2 ** (attempts - 1), settings.WORK_QUEUE_RETRY_MAX)
+    return random.uniform(delay / 2, delay)
+
+
+def redelivery_window():
+    """
+    seconds within which a job can still be run again: every attempt may be
+    reclaimed only after the visibility timeout, plus the backoff in between
+    """
+    return settings.WORK_QUEUE_MAX_ATTEMPTS * (settings.WORK_QUEUE_VISIBILITY_TIMEOUT + settings.WORK_QUEUE_RETRY_MAX)
+
+
+def retry_or_bury(fields, error=''):
+    attempts = int(fields.get('attempts', 0)) + 1
+    if attempts >= settings.WORK_QUEUE_MAX_ATTEMPTS:
+        metrics.ERRORS.labels('job_dead_letter').inc()
+        cache.xadd(DEAD_LETTER_KEY, dict(fields, attempts=attempts, error=error[-2000:], failed_at=int(time.time())))
+        print('job moved to dead letter queue', fields.get('type'))
+        return
+    job = json.dumps({
+        'type': fields.get('type'),
+        'payload': fields.get('payload'),
+        'attempts': attempts,
+        'nonce': random.random(),
+    })
+    cache.zadd(DELAYED_KEY, {job: time.time() + backoff(attempts)})
+    metrics.RETRIES.labels('job').inc()
+
+
+def promote_delayed():
+    return _PROMOTE_SCRIPT(keys=[DELAYED_KEY, STREAM_KEY], args=[time.time(), settings.WORK_QUEUE_MAXLEN])
+
+
+def stats():
+    return {
+        'length': cache.xlen(STREAM_KEY),
+        'delayed': cache.zcard(DELAYED_KEY),
+        'dead': cache.xlen(DEAD_LETTER_KEY),
+        'pending': cache.xpending(STREAM_KEY, GROUP).get('pending', 0),
+    }
+
+
+class Worker:
+    """
+    handlers: dict of job type -> async function taking the job payload.
+        A job that raises is run again, so handlers must be safe to repeat
+    concurrency: the maximum number of jobs processed at the same time
+    periodic: list of (interval in seconds, function) run in the threadpool
+        by the maintenance loop, e.g. housekeeping every worker may do
+    """
+
+    def __init__(self, handlers, concurrency=None, name=None, periodic=()):
+        self.handlers = handlers
+        self.periodic = periodic
+        self._last_run = {}
+        self.concurrency = concurrency or settings.PIPELINE_WORKERS
+        self.name = name or '%s-%s' % (socket.gethostname(), os.getpid())
+        self._running = False
+        self._tasks = set()
+
+    def __repr__(self):
+        return f'<Worker {self.name} concurrency={self.concurrency}>'
+
+    async def run(self):
+        await run_in_threadpool(ensure_group)
+        self._running = True
+        slots = asyncio.Semaphore(self.concurrency)
+        maintenance = asyncio.create_task(self._maintain())
+        print('worker started', self)
+
+        while self._running:
+            await slots.acquire()
+            if not self._running:
+                # stopped while waiting for a slot, do not claim a job nobody will process
+                slots.release()
+                break
+            try:
+                entries = await run_in_threadpool(
+                    cache.xreadgroup, GROUP, self.name, {STREAM_KEY: '>'},
+                    count=1, block=settings.WORK_QUEUE_BLOCK_MS
+                )
+            except Exception:
+                slots.release()
+                traceback.print_exc()
+                await asyncio.sleep(1)
+                continue
+
+            if not entries:
+                slots.release()
+                continue
+
+            for _, messages in entries:
+                for entry_id, fields in messages:
+                    task = asyncio.create_task(self._process(entry_id, fields))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    task.add_done_callback(lambda _: slots.release())
+
+        maintenance.cancel()
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=settings.WORK_QUEUE_SHUTDOWN_TIMEOUT)
+
+    def stop(self):
+        """ stop reading new jobs, in flight jobs are allowed to finish """
+        self._running = False
+
+    async def _process(self, entry_id, fields):
+        handler = self.handlers.get(fields.get('type'))
+        try:
+            if handler is None:
+                raise ValueError('no handler for job type %s' % fields.get('type'))
+            # below the visibility timeout, so the job is not reclaimed and run twice at once
+            await asyncio.wait_for(handler(json.loads(fields['payload'])), settings.WORK_QUEUE_JOB_TIMEOUT)
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+            await run_in_threadpool(retry_or_bury, fields, error)
+        await run_in_threadpool(self._ack, entry_id)
+
+    def _ack(self, entry_id):
+        pipe = cache.pipeline()
+        pipe.xack(STREAM_KEY, GROUP, entry_id)
+        pipe.xdel(STREAM_KEY, entry_id)
+        pipe.execute()
+
+    def _reclaim(self):
+        """ jobs pending for longer than the visibility timeout belong to a dead worker """
+        min_idle = int(settings.WORK_QUEUE_VISIBILITY_TIMEOUT * 1000)
+        claimed = cache.xautoclaim(STREAM_KEY, GROUP, self.name, min_idle, count=100)
+        for entry_id, fields in claimed[1]:
+            if fields:
+                retry_or_bury(fields, 'visibility timeout expired')
+            self._ack(entry_id)
+
+    async def _maintain(self):
+        while True:
+            try:
+                await run_in_threadpool(promote_delayed)
+                await run_in_threadpool(self._reclaim)
+            except Exception:
+                traceback.print_exc()
+            for interval, function in self.periodic:
+                if time.monotonic() - self._last_run.get(function, -interval) < interval:
+                    continue
+                self._last_run[function] = time.monotonic()
+                try:
+                    await run_in_threadpool(function)
+                except Exception:
+                    traceback.print_exc()
+            await asyncio.sleep(1)
@@ -0,0 +1,45 @@
+"""
+Standalone worker process for the message pipeline, so that LLM workers can
+be scaled separately from the webhook nodes. Set PIPELINE_EMBEDDED_WORKER=false
+on the web nodes when running this.
+
+    python worker.py --concurrency 8 --metrics-port 9100
+"""
+import argparse
+import asyncio
+import signal
+import cpu_pool
+import db
+import http_client
+import metrics
+import settings
+import pipeline
+import work_queue
+from prometheus_client import start_http_server
+
+
+async def main(concurrency, metrics_port):
+    db.init_db()
+    if metrics_port:
+        metrics.register_collectors()
+        start_http_server(metrics_port)
+    worker = work_queue.Worker(pipeline.HANDLERS, concurrency=concurrency, periodic=pipeline.PERIODIC)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    try:
+        await worker.run()
+    finally:
+        db.message_writer.close()
+        http_client.close()
+        await http_client.aclose()
+        cpu_pool.shutdown()
+        await db.async_engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='wechatbot message worker')
+    parser.add_argument('--concurrency', type=int, default=None, help='max messages handled at once')
+    parser.add_argument('--metrics-port', type=int, default=settings.WORKER_METRICS_PORT, help='serve /metrics on this port')
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency, args.metrics_port))
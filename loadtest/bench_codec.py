@@ -0,0 +1,76 @@
+"""
+Parse and render overhead of the /wechat webhook: xmltodict plus % formatting
+(the old path) against wechat_codec.
+
+    python bench_codec.py --number 20000
+"""
+import argparse
+import os
+import sys
+import time
+import timeit
+
+os.environ.setdefault('ENV', 'bench')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import xmltodict
+import wechat_codec
+
+BODY = (
+    '<xml><ToUserName><![CDATA[gh_bench]]></ToUserName><FromUserName><![CDATA[oBench1234567890]]></FromUserName>'
+    '<CreateTime>1690000000</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+    '<Content><![CDATA[解释一下这句话: I\'m looking forward to our meeting tomorrow.]]></Content>'
+    '<MsgId>23456789012345678</MsgId></xml>'
+).encode('utf-8')
+
+REPLY = '[帮我解释下面这个英文句子]\n\n好的，你要我解释什么英文句子？直接发给我就行了'
+
+
+def old_parse():
+    message = xmltodict.parse(BODY)
+    xml = message['xml']
+    return xml.get('FromUserName'), xml.get('MsgType'), xml.get('Event'), xml.get('EventKey'), xml.get('MediaId')
+
+
+def old_render(message=xmltodict.parse(BODY)):
+    return (
+        "<xml>"
+        "<ToUserName><![CDATA[%s]]></ToUserName>"
+        "<FromUserName><![CDATA[%s]]></FromUserName>"
+        "<CreateTime>%s</CreateTime>"
+        "<MsgType><![CDATA[text]]></MsgType>"
+        "<Content><![CDATA[%s]]></Content>"
+        "</xml>"
+    ) % (message['xml']['FromUserName'], message['xml']['ToUserName'], int(time.time()), REPLY)
+
+
+def new_parse():
+    message = wechat_codec.parse(BODY)
+    return message.from_user, message.msg_type, message.event, message.event_key, message.media_id
+
+
+def new_render(message=wechat_codec.parse(BODY)):
+    return wechat_codec.render_text_reply(message, REPLY)
+
+
+def report(name, fn, number):
+    seconds = min(timeit.repeat(fn, number=number, repeat=5))
+    print('%-32s %8.2f us/call' % (name, seconds / number * 1e6))
+    return seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='webhook codec benchmark')
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    old = report('xmltodict parse', old_parse, args.number)
+    new = report('wechat_codec parse', new_parse, args.number)
+    print('parse speedup %.1fx' % (old / new))
+    old = report('% format render', old_render, args.number)
+    new = report('wechat_codec render', new_render, args.number)
+    print('render speedup %.1fx' % (old / new))
+
+    key = 'a' * 43
+    crypto = wechat_codec.MessageCrypto('token', key, 'wx_bench')
+    report('encrypt reply', lambda: crypto.encrypt(new_render()), args.number // 10)
@@ -0,0 +1,244 @@
+"""
+Local stand-ins for the external APIs the bot calls, so that load tests do not
+hit (or pay for) WeChat, OpenAI, Whisper or play.ht. All of them are served by
+one app on different path prefixes:
+
+    /cgi-bin/...                WeChat: token, custom send/typing, media upload/get, menu
+    /v1/chat/completions        OpenAI chat, streamed at FAKE_TOKENS_PER_SECOND
+    /v1/audio/transcriptions    Whisper
+    /playht/...                 play.ht convert, articleStatus and the audio file
+
+Run the bot against it with
+
+    WECHAT_API_BASE_URL=http://localhost:9000/cgi-bin
+    OPENAI_API_BASE=http://localhost:9000/v1
+    PLAYHT_API_BASE_URL=http://localhost:9000/playht
+    WECHAT_TOKEN_SELF_REFRESH=true
+
+    uvicorn fake_services:app --port 9000
+
+Every message sent through the WeChat custom send API is recorded, and
+load_generator.py waits on /_loadtest/deliveries to measure reply latency.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import defaultdict
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
+import httpx
+
+TOKENS_PER_SECOND = float(os.getenv('FAKE_TOKENS_PER_SECOND', 30))
+ANSWER_TOKENS = int(os.getenv('FAKE_ANSWER_TOKENS', 150))
+WECHAT_LATENCY = float(os.getenv('FAKE_WECHAT_LATENCY', 0.05))
+WHISPER_SECONDS = float(os.getenv('FAKE_WHISPER_SECONDS', 1))
+TTS_SECONDS = float(os.getenv('FAKE_TTS_SECONDS', 3))
+
+# answers look like the real ones: chinese explanation, english examples, several paragraphs
+ANSWER_PARTS = [
+    '这个短语', ' "against', ' all', ' odds"', ' 意思是', '"尽管', '困难', '重重"。', '它', '用来', '形容', '在',
+    '困难', '的', '情况下', '取得', '成功。', '\n\n', '比如', '：', 'Despite', ' facing', ' financial', ' difficulties,',
+    ' she', ' succeeded', ' against', ' all', ' odds.', '（', '尽管', '面临', '财务', '困难', '，', '她', '还是',
+    '成功', '了', '。）', '\n\n',
+]
+
+# one second of silence in AMR-NB 12.2kbit/s, what WeChat voice messages are recorded in
+SILENT_AMR = b'#!AMR\n' + (b'\x3c' + b'\x00' * 31) * 50
+# not decodable, only stored and uploaded again by the bot
+FAKE_MP3 = b'ID3\x03\x00\x00\x00\x00\x00\x00' + b'\x00' * 4096
+
+app = FastAPI()
+
+_deliveries = defaultdict(list)
+_delivery_events = defaultdict(asyncio.Event)
+_tts_jobs = {}
+_counts = defaultdict(int)
+
+
+def _answer_tokens():
+    tokens = []
+    while len(tokens) < ANSWER_TOKENS:
+        tokens.extend(ANSWER_PARTS)
+    return tokens[:ANSWER_TOKENS]
+
+
+def _wechat_ok(**fields):
+    return dict({'errcode': 0, 'errmsg': 'ok'}, **fields)
+
+
+# WeChat
+
+@app.get('/cgi-bin/token')
+async def wechat_token():
+    _counts['wechat_token'] += 1
+    return {'access_token': 'fake-' + uuid.uuid4().hex, 'expires_in': 7200}
+
+
+@app.post('/cgi-bin/message/custom/send')
+async def wechat_send(request: Request):
+    await asyncio.sleep(WECHAT_LATENCY)
+    data = json.loads(await request.body())
+    _counts['wechat_send'] += 1
+    touser = data.get('touser')
+    _deliveries[touser].append({'time': time.time(), 'msgtype': data.get('msgtype'), 'data': data})
+    _delivery_events[touser].set()
+    return _wechat_ok()
+
+
+@app.post('/cgi-bin/message/custom/typing')
+async def wechat_typing():
+    await asyncio.sleep(WECHAT_LATENCY)
+    _counts['wechat_typing'] += 1
+    return _wechat_ok()
+
+
+@app.post('/cgi-bin/media/upload')
+async def wechat_upload(request: Request):
+    await request.body()
+    await asyncio.sleep(WECHAT_LATENCY * 4)
+    _counts['wechat_upload'] += 1
+    return {'type': 'voice', 'media_id': 'fake-media-' + uuid.uuid4().hex, 'created_at': int(time.time())}
+
+
+@app.get('/cgi-bin/media/get')
+async def wechat_media(media_id: str):
+    await asyncio.sleep(WECHAT_LATENCY)
+    _counts['wechat_media_get'] += 1
+    return Response(content=SILENT_AMR, media_type='audio/amr')
+
+
+@app.post('/cgi-bin/menu/create')
+async def wechat_menu():
+    return _wechat_ok()
+
+
+# OpenAI
+
+async def _stream_chat(model):
+    completion_id = 'chatcmpl-' + uuid.uuid4().hex
+    for token in _answer_tokens():
+        await asyncio.sleep(1 / TOKENS_PER_SECOND)
+        chunk = {
+            'id': completion_id,
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}],
+        }
+        yield 'data: %s\n\n' % json.dumps(chunk, ensure_ascii=False)
+    done = {
+        'id': completion_id,
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+    }
+    yield 'data: %s\n\n' % json.dumps(done)
+    yield 'data: [DONE]\n\n'
+
+
+@app.post('/v1/chat/completions')
+async def openai_chat(request: Request):
+    data = await request.json()
+    model = data.get('model', 'gpt-3.5-turbo')
+    _counts['openai_chat'] += 1
+    if data.get('stream'):
+        return StreamingResponse(_stream_chat(model), media_type='text/event-stream')
+
+    tokens = _answer_tokens()
+    await asyncio.sleep(len(tokens) / TOKENS_PER_SECOND)
+    return {
+        'id': 'chatcmpl-' + uuid.uuid4().hex,
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 500, 'completion_tokens': len(tokens), 'total_tokens': 500 + len(tokens)},
+    }
+
+
+@app.post('/v1/audio/transcriptions')
+async def openai_transcribe(request: Request):
+    await request.body()
+    await asyncio.sleep(WHISPER_SECONDS)
+    _counts['whisper'] += 1
+    return {'text': 'bite the bullet 是什么意思?'}
+
+
+# play.ht
+
+async def _tts_callback(callback_url, status):
+    await asyncio.sleep(TTS_SECONDS)
+    async with httpx.AsyncClient() as client:
+        await client.post(callback_url, json=status)
+
+
+@app.post('/playht/convert')
+async def playht_convert(request: Request):
+    data = await request.json()
+    _counts['tts_convert'] += 1
+    transcription_id = uuid.uuid4().hex
+    _tts_jobs[transcription_id] = time.time() + TTS_SECONDS
+    callback_url = data.get('callbackUrl')
+    if callback_url:
+        asyncio.create_task(_tts_callback(callback_url, _tts_status(request, transcription_id, done=True)))
+    return {'status': 'CREATED', 'transcriptionId': transcription_id, 'contentLength': len(data.get('content', []))}
+
+
+def _tts_status(request, transcription_id, done):
+    if not done:
+        return {'transcriptionId': transcription_id, 'converted': False}
+    return {
+        'transcriptionId': transcription_id,
+        'converted': True,
+        'audioUrl': str(request.url_for('playht_audio', transcription_id=transcription_id)),
+        'audioDuration': 12.5,
+    }
+
+
+@app.get('/playht/articleStatus')
+async def playht_status(request: Request, transcriptionId: str):
+    _counts['tts_status'] += 1
+    ready_at = _tts_jobs.get(transcriptionId)
+    return _tts_status(request, transcriptionId, done=ready_at is not None and ready_at <= time.time())
+
+
+@app.get('/playht/audio/{transcription_id}.mp3')
+async def playht_audio(transcription_id: str):
+    return Response(content=FAKE_MP3, media_type='audio/mpeg')
+
+
+# used by load_generator.py
+
+@app.get('/_loadtest/deliveries')
+async def deliveries(touser: str, count: int = 1, timeout: float = 60):
+    """ waits until at least count messages were sent to touser, returns them """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    event = _delivery_events[touser]
+    while len(_deliveries[touser]) < count:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        event.clear()
+        try:
+            await asyncio.wait_for(event.wait(), remaining)
+        except asyncio.TimeoutError:
+            break
+    return [{'time': item['time'], 'msgtype': item['msgtype']} for item in _deliveries[touser]]
+
+
+@app.get('/_loadtest/stats')
+async def stats():
+    return dict(_counts)
+
+
+@app.post('/_loadtest/reset')
+async def reset():
+    _deliveries.clear()
+    _delivery_events.clear()
+    _tts_jobs.clear()
+    _counts.clear()
+    return {}
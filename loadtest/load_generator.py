@@ -0,0 +1,188 @@
+"""
+Replays WeChat webhooks against a running bot and reports latency and throughput.
+
+Start fake_services.py and the bot pointed at it (see fake_services.py), then
+
+    python load_generator.py --messages 500 --concurrency 50 --mix text=7,voice=2,click=1
+
+Every message comes from a new openid so replies can be told apart. For each
+message type two latencies are reported: ack, the time until the webhook
+returned, and reply, the time until the first message reached the (fake)
+WeChat send API. Menu clicks are answered in the webhook response, so for them
+both are the same.
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+import uuid
+from collections import defaultdict
+import httpx
+
+TEXT_MESSAGES = [
+    'bite the bullet 是什么意思?',
+    '怎么用英文说 "我这几天有点不舒服，明天可能来不了你的家"?',
+    '解释一下这句话: I\'m looking forward to our meeting tomorrow.',
+    'break the ice 怎么用?',
+]
+
+XML_TEMPLATES = {
+    'text': (
+        '<xml><ToUserName><![CDATA[gh_loadtest]]></ToUserName><FromUserName><![CDATA[%(user)s]]></FromUserName>'
+        '<CreateTime>%(time)s</CreateTime><MsgType><![CDATA[text]]></MsgType>'
+        '<Content><![CDATA[%(content)s]]></Content><MsgId>%(msg_id)s</MsgId></xml>'
+    ),
+    'voice': (
+        '<xml><ToUserName><![CDATA[gh_loadtest]]></ToUserName><FromUserName><![CDATA[%(user)s]]></FromUserName>'
+        '<CreateTime>%(time)s</CreateTime><MsgType><![CDATA[voice]]></MsgType>'
+        '<MediaId><![CDATA[%(media_id)s]]></MediaId><Format><![CDATA[amr]]></Format><MsgId>%(msg_id)s</MsgId></xml>'
+    ),
+    'click': (
+        '<xml><ToUserName><![CDATA[gh_loadtest]]></ToUserName><FromUserName><![CDATA[%(user)s]]></FromUserName>'
+        '<CreateTime>%(time)s</CreateTime><MsgType><![CDATA[event]]></MsgType>'
+        '<Event><![CDATA[CLICK]]></Event><EventKey><![CDATA[explain]]></EventKey></xml>'
+    ),
+}
+
+
+def sign(token, timestamp, nonce):
+    """ the signature WeChat adds to every webhook call """
+    return hashlib.sha1(''.join(sorted([token, timestamp, nonce])).encode('utf-8')).hexdigest()
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        if name not in XML_TEMPLATES:
+            raise ValueError('unknown message type %s' % name)
+        weights[name] = float(weight)
+    return weights
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class LoadTest:
+
+    def __init__(self, args):
+        self.args = args
+        self.run_id = uuid.uuid4().hex[:8]
+        self.ack_latencies = defaultdict(list)
+        self.reply_latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.timeouts = defaultdict(int)
+        self._msg_id = random.randrange(10 ** 12)
+
+    def render(self, msg_type, user):
+        self._msg_id += 1
+        return XML_TEMPLATES[msg_type] % {
+            'user': user,
+            'time': int(time.time()),
+            'content': random.choice(TEXT_MESSAGES),
+            'media_id': 'loadtest-media-%s' % self._msg_id,
+            'msg_id': self._msg_id,
+        }
+
+    async def send_one(self, client, index, msg_type):
+        user = 'loadtest-%s-%s' % (self.run_id, index)
+        body = self.render(msg_type, user)
+        timestamp = str(int(time.time()))
+        nonce = uuid.uuid4().hex[:10]
+        params = {'signature': sign(self.args.token, timestamp, nonce), 'timestamp': timestamp, 'nonce': nonce, 'openid': user}
+
+        started = time.perf_counter()
+        started_at = time.time()
+        try:
+            response = await client.post(self.args.target + '/wechat', params=params, content=body.encode('utf-8'),
+                                         headers={'Content-Type': 'text/xml'})
+            response.raise_for_status()
+        except httpx.HTTPError:
+            self.errors[msg_type] += 1
+            return
+        ack = time.perf_counter() - started
+        self.ack_latencies[msg_type].append(ack)
+
+        if msg_type == 'click':
+            self.reply_latencies[msg_type].append(ack)
+            return
+
+        try:
+            response = await client.get(self.args.fake + '/_loadtest/deliveries',
+                                        params={'touser': user, 'timeout': self.args.reply_timeout},
+                                        timeout=self.args.reply_timeout + 5)
+            delivered = response.json()
+        except httpx.HTTPError:
+            self.errors[msg_type] += 1
+            return
+        if not delivered:
+            self.timeouts[msg_type] += 1
+            return
+        self.reply_latencies[msg_type].append(delivered[0]['time'] - started_at)
+
+    async def run(self):
+        weights = parse_mix(self.args.mix)
+        types = random.choices(list(weights), list(weights.values()), k=self.args.messages)
+        slots = asyncio.Semaphore(self.args.concurrency)
+        limits = httpx.Limits(max_connections=self.args.concurrency * 2 + 10)
+
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            async def task(index, msg_type):
+                async with slots:
+                    await self.send_one(client, index, msg_type)
+
+            started = time.perf_counter()
+            tasks = []
+            for index, msg_type in enumerate(types):
+                tasks.append(asyncio.create_task(task(index, msg_type)))
+                if self.args.rate:
+                    await asyncio.sleep(1 / self.args.rate)
+            await asyncio.gather(*tasks)
+            elapsed = time.perf_counter() - started
+
+            try:
+                stats = (await client.get(self.args.fake + '/_loadtest/stats')).json()
+            except httpx.HTTPError:
+                stats = {}
+        self.report(elapsed, stats)
+
+    def report(self, elapsed, stats):
+        print('%-6s %6s %6s %8s %9s %9s %9s %9s' % ('type', 'ok', 'failed', 'timeout', 'ack p50', 'ack p99', 'reply p50', 'reply p99'))
+        replied = 0
+        for msg_type in XML_TEMPLATES:
+            acks = self.ack_latencies[msg_type]
+            replies = self.reply_latencies[msg_type]
+            if not acks and not self.errors[msg_type]:
+                continue
+            replied += len(replies)
+            print('%-6s %6d %6d %8d %9s %9s %9s %9s' % (
+                msg_type, len(replies), self.errors[msg_type], self.timeouts[msg_type],
+                _ms(percentile(acks, 50)), _ms(percentile(acks, 99)),
+                _ms(percentile(replies, 50)), _ms(percentile(replies, 99)),
+            ))
+        print('%d messages answered in %.1fs, %.1f messages/sec' % (replied, elapsed, replied / elapsed))
+        if stats:
+            print('fake api calls:', ', '.join('%s=%s' % item for item in sorted(stats.items())))
+
+
+def _ms(seconds):
+    return '-' if seconds is None else '%dms' % (seconds * 1000)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='wechatbot load generator')
+    parser.add_argument('--target', default='http://localhost:8000', help='the bot under test')
+    parser.add_argument('--fake', default='http://localhost:9000', help='fake_services.py')
+    parser.add_argument('--token', default='', help='WECHAT_BOT_TOKEN of the bot, used to sign the webhooks')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20, help='messages in flight at once')
+    parser.add_argument('--rate', type=float, default=0, help='new messages per second, 0 to send as fast as concurrency allows')
+    parser.add_argument('--mix', default='text=7,voice=2,click=1', help='relative weights of each message type')
+    parser.add_argument('--reply-timeout', type=float, default=60, help='seconds to wait for the first reply')
+    asyncio.run(LoadTest(parser.parse_args()).run())
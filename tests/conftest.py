@@ -0,0 +1,9 @@
+import os
+import sys
+
+# the app modules import each other by their bare names, from the app directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+# db.py creates its engines and the redis client at import, none of them connects until used
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379/0')
+os.environ.setdefault('SQLALCHEMY_DATABASE_URL', 'postgresql://localhost/wechatbot_test')
@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip('hanziconv')
+pytest.importorskip('sqlalchemy')
+pytest.importorskip('redis')
+
+from response_cache import normalize
+
+
+@pytest.mark.parametrize('first, second', [
+    ("it's", 'its'),
+    ('every day', 'everyday'),
+    ('a part', 'apart'),
+    ('may be', 'maybe'),
+])
+def test_english_distinctions_are_kept(first, second):
+    assert normalize(first) != normalize(second)
+
+
+@pytest.mark.parametrize('first, second', [
+    ("It’s  OK?", "it's ok"),
+    ('"Hello," she said', 'hello she said'),
+    ('bite the bullet 是什么意思?', 'Bite the  bullet是 什么 意思？'),
+    ('咬緊牙關是什麼意思', '咬紧牙关 是什么意思'),
+])
+def test_equivalent_questions_match(first, second):
+    assert normalize(first) == normalize(second)
+
+
+def test_spacing_next_to_chinese_is_dropped():
+    assert normalize('bite the bullet 是 什么 意思') == 'bite the bullet是什么意思'